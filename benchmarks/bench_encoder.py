@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# Usage:
+#  ./benchmarks/bench_encoder.py --model_name 117M
+#  ./benchmarks/bench_encoder.py --text some_file.txt
+#
+# Encoder.encode throughput in chars/s, on a cold BPE cache (a fresh encoder)
+# and a warm one (encoding the same text again). Uses the model's encoder if
+# models/<model_name> exists, otherwise a byte-level encoder with no merges.
+
+import argparse
+import json
+import time
+
+import common
+
+parser = argparse.ArgumentParser(
+    description='Benchmark Encoder.encode throughput.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--model_name', type=str, default='117M', help='Model whose encoder.json and vocab.bpe to use, if downloaded.')
+parser.add_argument('--text', type=str, default=None, help='Text file to encode (default: synthetic text).')
+parser.add_argument('--chars', type=int, default=1000000, help='Number of characters to encode.')
+
+def bench(args):
+    if args.text:
+        with open(args.text, encoding='utf-8', errors='replace') as f:
+            text = f.read(args.chars)
+    else:
+        text = common.synthetic_text(args.chars)
+    results = []
+    enc, description = common.get_encoder(args.model_name)
+    for cache in ['cold', 'warm']:
+        start = time.time()
+        tokens = enc.encode(text)
+        elapsed = time.time() - start
+        results.append({
+            'benchmark': 'encode',
+            'name': 'encode/%s' % cache,
+            'encoder': description,
+            'chars': len(text),
+            'tokens': len(tokens),
+            'secs': elapsed,
+            'chars_per_sec': len(text) / elapsed,
+        })
+    return results
+
+def main():
+    args = parser.parse_args()
+    print(json.dumps(bench(args), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Usage:
+#  ./benchmarks/bench_graph_build.py --n_layer 48
+#  ./benchmarks/bench_graph_build.py --n_layer 48 --legacy
+#
+# Times building the GPT-2 graph (model.model, then a second reusing build as
+# sampling does), which is dominated by Python-side variable lookups rather
+# than TensorFlow. --legacy swaps in the old linear-scan model.get_variable
+# for comparison.
+
+import argparse
+import json
+import os
+import time
+
+import common
+
+import tensorflow as tf
+
+import model
+
+parser = argparse.ArgumentParser(
+    description='Benchmark GPT-2 graph construction time.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--n_layer', type=int, default=48, help='Number of transformer layers.')
+parser.add_argument('--n_embd', type=int, default=64, help='Embedding size (kept small; it does not affect build time much).')
+parser.add_argument('--n_head', type=int, default=4, help='Number of attention heads.')
+parser.add_argument('--n_vocab', type=int, default=1024, help='Vocabulary size.')
+parser.add_argument('--repeat', type=int, default=3, help='Number of fresh graphs to build; the best time is reported.')
+parser.add_argument('--legacy', default=False, action='store_true', help='Use the old linear scan over tf.trainable_variables() in model.get_variable.')
+
+def legacy_get_variable(name):
+    name = os.path.join(tf.get_variable_scope().name, name)
+    for x in tf.trainable_variables():
+        if x.name.startswith(name + ':'):
+            return x
+
+def build(hparams):
+    with tf.Graph().as_default():
+        context = tf.placeholder(tf.int32, [1, None])
+        start = time.time()
+        model.model(hparams=hparams, X=context)
+        first = time.time() - start
+        start = time.time()
+        model.model(hparams=hparams, X=context)
+        second = time.time() - start
+        return first, second, len(tf.trainable_variables())
+
+def bench(args):
+    hparams = common.small_hparams(n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head, n_vocab=args.n_vocab)
+    get_variable = model.get_variable
+    if args.legacy:
+        model.get_variable = legacy_get_variable
+    try:
+        results = [build(hparams) for _ in range(args.repeat)]
+    finally:
+        model.get_variable = get_variable
+    return [{
+        'benchmark': 'graph_build',
+        'name': 'graph_build/n_layer=%d%s' % (args.n_layer, '/legacy' if args.legacy else ''),
+        'n_layer': args.n_layer,
+        'variables': results[0][2],
+        'legacy': args.legacy,
+        'build_secs': min([first for first, _, _ in results]),
+        'rebuild_secs': min([second for _, second, _ in results]),
+    }]
+
+def main():
+    args = parser.parse_args()
+    print(json.dumps(bench(args), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Usage:
+#  ./benchmarks/bench_sample.py --batch_sizes 1,4 --length 64
+#
+# sample.sample_sequence throughput (generated tokens/s) and time to first
+# token (a run of the same graph with length 1, which includes encoding the
+# context) for a randomly initialized model.
+
+import argparse
+import json
+
+import common
+
+import numpy as np
+import tensorflow as tf
+
+import sample
+
+parser = argparse.ArgumentParser(
+    description='Benchmark sample_sequence throughput and time to first token.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--batch_sizes', type=common.int_list, default='1,4', help='Comma separated batch sizes.')
+parser.add_argument('--context_length', type=int, default=32, help='Number of context tokens.')
+parser.add_argument('--length', type=int, default=64, help='Number of tokens to generate.')
+parser.add_argument('--n_layer', type=int, default=2, help='Number of transformer layers.')
+parser.add_argument('--n_embd', type=int, default=128, help='Embedding size.')
+parser.add_argument('--n_head', type=int, default=4, help='Number of attention heads.')
+parser.add_argument('--n_vocab', type=int, default=1024, help='Vocabulary size.')
+parser.add_argument('--top_k', type=int, default=40, help='top_k passed to sample_sequence.')
+parser.add_argument('--repeat', type=int, default=5, help='Timed runs per configuration.')
+
+def bench_one(hparams, batch_size, args):
+    with tf.Graph().as_default(), tf.Session() as sess:
+        context = tf.placeholder(tf.int32, [batch_size, None])
+        first = sample.sample_sequence(hparams=hparams, length=1, context=context, batch_size=batch_size, top_k=args.top_k)
+        full = sample.sample_sequence(hparams=hparams, length=args.length, context=context, batch_size=batch_size, top_k=args.top_k)
+        sess.run(tf.global_variables_initializer())
+        tokens = np.random.RandomState(0).randint(0, hparams.n_vocab, size=(batch_size, args.context_length)).astype(np.int32)
+        ttft = common.timings(lambda: sess.run(first, feed_dict={context: tokens}), args.repeat)
+        times = common.timings(lambda: sess.run(full, feed_dict={context: tokens}), args.repeat)
+    result = {
+        'benchmark': 'sample_sequence',
+        'name': 'sample_sequence/batch=%d/context=%d/length=%d' % (batch_size, args.context_length, args.length),
+        'batch_size': batch_size,
+        'context_length': args.context_length,
+        'length': args.length,
+        'tokens_per_sec': batch_size * args.length / float(np.mean(times)),
+        'ttft_secs': float(np.median(ttft)),
+    }
+    result.update(common.stats(times))
+    return result
+
+def bench(args):
+    hparams = common.small_hparams(n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head, n_vocab=args.n_vocab, n_ctx=args.context_length + args.length)
+    return [bench_one(hparams, batch_size, args) for batch_size in args.batch_sizes]
+
+def main():
+    args = parser.parse_args()
+    print(json.dumps(bench(args), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Usage:
+#  ./benchmarks/bench_sampler.py --batch_sizes 8,64 --sample_ctxs 1024
+#
+# sample_batch latency of the dataset samplers train.py uses: Sampler over
+# in-memory chunks, MemmapSampler over a .tok file and TextSampler over raw
+# text, on synthetic data written to a temporary directory.
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+import common
+
+import numpy as np
+
+from load_dataset import Sampler, MemmapSampler, TextSampler, save_tokens
+
+parser = argparse.ArgumentParser(
+    description='Benchmark dataset sampler batch latency.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--batch_sizes', type=common.int_list, default='8,64', help='Comma separated batch sizes.')
+parser.add_argument('--sample_ctxs', type=common.int_list, default='1024', help='Comma separated sample lengths.')
+parser.add_argument('--tokens', type=int, default=20000000, help='Number of tokens in the synthetic Sampler/MemmapSampler dataset.')
+parser.add_argument('--chunk_size', type=int, default=50000, help='Tokens per chunk.')
+parser.add_argument('--text_chars', type=int, default=20000000, help='Number of characters in the synthetic TextSampler file.')
+parser.add_argument('--repeat', type=int, default=20, help='Timed batches per configuration.')
+
+def bench(args):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rs = np.random.RandomState(0)
+        chunks = [rs.randint(0, 50257, size=args.chunk_size).astype(np.int32) for _ in range(max(1, args.tokens // args.chunk_size))]
+        tok_path = os.path.join(tmpdir, 'data.tok')
+        save_tokens(tok_path, chunks)
+        text_path = os.path.join(tmpdir, 'data.txt')
+        with open(text_path, 'w') as f:
+            f.write(common.synthetic_text(args.text_chars))
+        enc, _ = common.get_encoder()
+        samplers = [
+            ('Sampler', Sampler(chunks, seed=0)),
+            ('MemmapSampler', MemmapSampler(tok_path, seed=0)),
+            ('TextSampler', TextSampler(text_path, enc, seed=0)),
+        ]
+        results = []
+        for name, sampler in samplers:
+            for length in args.sample_ctxs:
+                for batch_size in args.batch_sizes:
+                    times = common.timings(lambda: sampler.sample_batch(batch_size, length), args.repeat)
+                    result = {
+                        'benchmark': 'sampler',
+                        'name': 'sampler/%s/batch=%d/ctx=%d' % (name, batch_size, length),
+                        'sampler': name,
+                        'batch_size': batch_size,
+                        'sample_ctx': length,
+                        'tokens_per_sec': batch_size * length / float(np.mean(times)),
+                    }
+                    result.update(common.stats(times))
+                    results.append(result)
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+def main():
+    args = parser.parse_args()
+    print(json.dumps(bench(args), indent=2))
+
+if __name__ == '__main__':
+    main()
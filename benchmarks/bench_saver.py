@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Usage:
+#  ./benchmarks/bench_saver.py --megabytes 256
+#
+# tflex.Saver save and restore throughput in MB/s for a set of float32
+# variables, as a single .hdf5 file and as a sharded checkpoint, written to a
+# temporary directory.
+
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+import common
+
+import numpy as np
+import tensorflow as tf
+
+import tflex
+
+parser = argparse.ArgumentParser(
+    description='Benchmark tflex.Saver save/restore throughput.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--megabytes', type=int, default=256, help='Total size of the variables.')
+parser.add_argument('--variables', type=int, default=64, help='Number of variables.')
+parser.add_argument('--shards', type=common.int_list, default='0,4', help='Comma separated shard counts to test (0 for a single .hdf5 file).')
+parser.add_argument('--restore_threads', type=int, default=4, help='Threads used to restore.')
+parser.add_argument('--dir', type=str, default=None, help='Directory to write checkpoints in (default: a temporary directory).')
+
+def bench(args):
+    size = args.megabytes * 1024 * 1024 // 4 // args.variables
+    results = []
+    with tf.Graph().as_default(), tf.Session() as sess:
+        vs = [tf.get_variable('v%d' % i, [size], initializer=tf.random_normal_initializer()) for i in range(args.variables)]
+        sess.run(tf.global_variables_initializer())
+        nbytes = sum([np.prod(v.shape.as_list()) * 4 for v in vs])
+        for shards in args.shards:
+            tmpdir = tempfile.mkdtemp(dir=args.dir)
+            try:
+                saver = tflex.Saver(var_list=vs, sharded=shards, restore_threads=args.restore_threads)
+                start = time.time()
+                saver.save(sess, tmpdir + '/model', global_step=1)
+                save_secs = time.time() - start
+                start = time.time()
+                saver.restore(sess, tmpdir + '/model-1')
+                restore_secs = time.time() - start
+            finally:
+                shutil.rmtree(tmpdir)
+            results.append({
+                'benchmark': 'saver',
+                'name': 'saver/shards=%d' % shards,
+                'shards': shards,
+                'megabytes': nbytes / 1e6,
+                'save_secs': save_secs,
+                'restore_secs': restore_secs,
+                'save_mb_per_sec': nbytes / 1e6 / save_secs,
+                'restore_mb_per_sec': nbytes / 1e6 / restore_secs,
+            })
+    return results
+
+def main():
+    args = parser.parse_args()
+    print(json.dumps(bench(args), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# Usage:
+#  ./benchmarks/bench_train.py --batch_sizes 1,4 --sample_ctxs 64,256
+#
+# Training step throughput (tokens/s) of a randomly initialized model on the
+# default device, for each combination of batch size and context length. The
+# step is the same one train.py runs: softmax cross entropy, tf.gradients and
+# Adam with an in-graph global_step.
+
+import argparse
+import json
+
+import common
+
+import numpy as np
+import tensorflow as tf
+
+import model
+
+parser = argparse.ArgumentParser(
+    description='Benchmark training step throughput.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--batch_sizes', type=common.int_list, default='1,4', help='Comma separated batch sizes.')
+parser.add_argument('--sample_ctxs', type=common.int_list, default='64,256', help='Comma separated context lengths.')
+parser.add_argument('--n_layer', type=int, default=2, help='Number of transformer layers.')
+parser.add_argument('--n_embd', type=int, default=128, help='Embedding size.')
+parser.add_argument('--n_head', type=int, default=4, help='Number of attention heads.')
+parser.add_argument('--n_vocab', type=int, default=1024, help='Vocabulary size.')
+parser.add_argument('--steps', type=int, default=10, help='Timed steps per configuration.')
+parser.add_argument('--warmup', type=int, default=2, help='Untimed steps per configuration.')
+
+def bench_one(hparams, batch_size, sample_ctx, steps, warmup):
+    with tf.Graph().as_default(), tf.Session() as sess:
+        context = tf.placeholder(tf.int32, [batch_size, None])
+        output = model.model(hparams=hparams, X=context)
+        loss = tf.reduce_mean(
+            tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=context[:, 1:], logits=output['logits'][:, :-1]))
+        global_step = tf.train.get_or_create_global_step()
+        train_vars = tf.trainable_variables()
+        opt = tf.train.AdamOptimizer(learning_rate=1e-4)
+        opt_apply = opt.apply_gradients(list(zip(tf.gradients(loss, train_vars), train_vars)), global_step=global_step)
+        sess.run(tf.global_variables_initializer())
+        batch = np.random.RandomState(0).randint(0, hparams.n_vocab, size=(batch_size, sample_ctx)).astype(np.int32)
+        times = common.timings(lambda: sess.run((opt_apply, loss), feed_dict={context: batch}), steps, warmup=warmup)
+    result = {
+        'benchmark': 'train_step',
+        'name': 'train_step/batch=%d/ctx=%d' % (batch_size, sample_ctx),
+        'batch_size': batch_size,
+        'sample_ctx': sample_ctx,
+        'tokens_per_sec': batch_size * sample_ctx / float(np.mean(times)),
+    }
+    result.update(common.stats(times))
+    return result
+
+def bench(args):
+    results = []
+    for sample_ctx in args.sample_ctxs:
+        hparams = common.small_hparams(n_layer=args.n_layer, n_embd=args.n_embd, n_head=args.n_head, n_vocab=args.n_vocab, n_ctx=max(sample_ctx, 1))
+        for batch_size in args.batch_sizes:
+            results.append(bench_one(hparams, batch_size, sample_ctx, args.steps, args.warmup))
+    return results
+
+def main():
+    args = parser.parse_args()
+    print(json.dumps(bench(args), indent=2))
+
+if __name__ == '__main__':
+    main()
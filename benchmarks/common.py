@@ -0,0 +1,66 @@
+"""Helpers shared by the benchmarks in this directory."""
+
+import os
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [root, os.path.join(root, 'src')]
+
+import numpy as np
+
+def small_hparams(n_layer=2, n_embd=128, n_head=4, n_vocab=1024, n_ctx=256):
+    """Randomly initialized GPT-2 hparams small enough to run on a CPU."""
+    import model
+    hparams = model.default_hparams()
+    hparams.override_from_dict(dict(n_layer=n_layer, n_embd=n_embd, n_head=n_head, n_vocab=n_vocab, n_ctx=n_ctx))
+    return hparams
+
+def timings(fn, repeat, warmup=1):
+    """Call fn() warmup + repeat times and return the last `repeat` durations in seconds."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return times
+
+def stats(times):
+    """Summarize durations as mean/p50/p90/p99/min seconds."""
+    times = np.asarray(times, dtype=np.float64)
+    return {
+        'mean_secs': float(times.mean()),
+        'p50_secs': float(np.percentile(times, 50)),
+        'p90_secs': float(np.percentile(times, 90)),
+        'p99_secs': float(np.percentile(times, 99)),
+        'min_secs': float(times.min()),
+    }
+
+def int_list(text):
+    return [int(x) for x in text.split(',') if x]
+
+def synthetic_text(n_chars, seed=0):
+    """Random lowercase 'words' and lines, for benchmarks that need text but no dataset."""
+    rs = np.random.RandomState(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    words = []
+    size = 0
+    while size < n_chars:
+        word = ''.join(rs.choice(letters, rs.randint(1, 10)))
+        word += '\n' if rs.rand() < 0.05 else ' '
+        words.append(word)
+        size += len(word)
+    return ''.join(words)[:n_chars]
+
+def get_encoder(model_name=None):
+    """Return (encoder, description): the model's BPE encoder if models/<model_name> exists,
+    otherwise a byte-level Encoder with no merges."""
+    import encoder
+    if model_name and os.path.exists(os.path.join('models', model_name, 'encoder.json')):
+        enc = encoder.get_encoder(model_name)
+        return enc, '%s:%s' % (type(enc).__name__, model_name)
+    units = list(encoder.bytes_to_unicode().values())
+    enc = encoder.Encoder(encoder=dict([(c, i) for i, c in enumerate(units)]), bpe_merges=[])
+    return enc, 'Encoder:bytes'
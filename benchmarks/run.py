@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# Usage:
+#  ./benchmarks/run.py --output bench-$(git rev-parse --short HEAD).json
+#  ./benchmarks/run.py --only train_step,sampler --compare bench-old.json
+#
+# Runs the benchmarks in this directory with their default settings (small,
+# randomly initialized models on the default device) and writes the results
+# as JSON. With --compare, prints each metric next to the same metric in an
+# earlier results file.
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+
+import common
+
+import bench_encoder
+import bench_graph_build
+import bench_sample
+import bench_sampler
+import bench_saver
+import bench_train
+
+benchmarks = [
+    ('graph_build', bench_graph_build),
+    ('train_step', bench_train),
+    ('sample_sequence', bench_sample),
+    ('encode', bench_encoder),
+    ('sampler', bench_sampler),
+    ('saver', bench_saver),
+]
+
+parser = argparse.ArgumentParser(
+    description='Run the benchmark suite and write the results as JSON.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--only', type=str, default=None, help='Comma separated benchmarks to run, out of: %s' % ','.join([name for name, _ in benchmarks]))
+parser.add_argument('--output', type=str, default=None, help='Write the results to this JSON file (default: stdout).')
+parser.add_argument('--compare', type=str, default=None, help='Results file from an earlier run to compare against.')
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=common.root).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    old = dict([(result['name'], result) for result in baseline['results']])
+    for result in results:
+        if result['name'] not in old:
+            continue
+        for key, value in sorted(result.items()):
+            prev = old[result['name']].get(key)
+            if key.endswith(('_per_sec', '_secs')) and isinstance(value, float) and prev:
+                print('%-60s %-20s %12.4f %12.4f %+7.1f%%' % (result['name'], key, prev, value, 100.0 * (value - prev) / prev))
+
+def main():
+    args = parser.parse_args()
+    only = args.only.split(',') if args.only else None
+    import tensorflow as tf
+    report = {
+        'commit': git_commit(),
+        'time': time.time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'tensorflow': tf.__version__,
+        'results': [],
+    }
+    for name, module in benchmarks:
+        if only is not None and name not in only:
+            continue
+        print('Running %s...' % name, file=sys.stderr)
+        report['results'] += module.bench(module.parser.parse_args([]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report['results'], json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Usage:
+#  ./convert_checkpoint.py models/117M/model.ckpt models/117M/model.hdf5
+#  ./convert_checkpoint.py checkpoint/run1/model-1000 export/model-1000.hdf5 --dtype float16
+#  ./convert_checkpoint.py checkpoint/run1/model-1000 checkpoint/run2/model-1000.shards.json --shards 8
+#  ./convert_checkpoint.py checkpoint/run1/model-1000 out/model.ckpt --like models/345M/model.ckpt
+#  ./convert_checkpoint.py checkpoint/run1/model-1000 export/model-1000.tensors
+#
+# Streams tensors from any checkpoint format tflex.Saver can restore (TF .ckpt,
+# .hdf5, sharded .shards.json, .tensors, pickled -N.npy) into .hdf5,
+# .shards.json, .tensors or .ckpt, one tensor (or one bundle, for .ckpt) at a
+# time, without building the model graph.
+
+import argparse
+import math
+import os
+import re
+import sys
+
+import numpy as np
+import tqdm
+
+import tflex
+
+parser = argparse.ArgumentParser(
+    description='Convert a checkpoint between the ckpt, hdf5, tensors and npy formats.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('src', metavar='SRC', type=str, help='Checkpoint to read (anything tflex.Saver.restore accepts).')
+parser.add_argument('dst', metavar='DST', type=str, help='Checkpoint to write: <path>.hdf5, <prefix>.shards.json, <path>.tensors or <path>.ckpt')
+parser.add_argument('--dtype', type=str, default=None, help='Cast floating point tensors to this dtype (e.g. float16, bfloat16).')
+parser.add_argument('--rename', metavar='REGEX=REPLACEMENT', type=str, action='append', default=[], help='Rename tensors with re.sub; may be given several times.')
+parser.add_argument('--like', metavar='PATH', type=str, default=None, help='Truncate or tile tensors to the shapes they have in this checkpoint.')
+parser.add_argument('--shape', metavar='NAME=D1,D2,...', type=str, action='append', default=[], help='Truncate or tile the (renamed) tensor NAME to this shape; may be given several times.')
+parser.add_argument('--shards', metavar='N', type=int, default=4, help='Number of shards when writing .shards.json')
+parser.add_argument('--compression', type=str, default=None, help='hdf5 compression filter <gzip|lzf>.')
+parser.add_argument('--include_state', default=False, action='store_true', help='Also copy the extra training state saved by tflex.Saver.')
+
+def parse_shapes(specs):
+    shapes = {}
+    for spec in specs:
+        name, dims = spec.rsplit('=', 1)
+        name = name if ':' in name else name + ':0'
+        shapes[name] = [int(x) for x in dims.split(',') if x]
+    return shapes
+
+def main():
+    args = parser.parse_args()
+    reader = tflex.CheckpointReader(args.src, include_state=args.include_state)
+    like = tflex.CheckpointReader(args.like) if args.like else None
+    like_names = set(like.names()) if like else set()
+    shapes = parse_shapes(args.shape)
+    renames = [spec.split('=', 1) for spec in args.rename]
+
+    def rename(name):
+        for pattern, replacement in renames:
+            name = re.sub(pattern, replacement, name)
+        return name
+
+    def target_shape(name):
+        if name in shapes:
+            return shapes[name]
+        if name in like_names:
+            return like.shape(name)
+
+    def convert(name, value):
+        new_name = rename(name)
+        shape = target_shape(new_name)
+        if shape is not None:
+            value = tflex.truncate_array(new_name, value, shape)
+        if args.dtype is not None:
+            value = tflex.cast_value(value, args.dtype)
+        return new_name, value
+
+    def items(names, progress=False):
+        values = reader.items(names)
+        if progress:
+            values = tqdm.tqdm(values, total=len(names))
+        for name, value in values:
+            yield convert(name, value)
+
+    names = reader.names()
+    print('Converting %d tensors from %s to %s' % (len(names), args.src, args.dst))
+    if args.dst.endswith('.shards.json'):
+        # Partition by parameter count up front, from the shapes alone.
+        total = sum([np.prod(reader.shape(name)) for name in names])
+        groups = [[]]
+        count = 0
+        for name in names:
+            if count >= math.ceil(total / args.shards):
+                groups.append([])
+                count = 0
+            groups[-1].append(name)
+            count += np.prod(reader.shape(name))
+        prefix = args.dst[:-len('.shards.json')]
+        tflex.maketree(os.path.dirname(prefix))
+        tflex.write_sharded(prefix, [items(group) for group in groups], compression=args.compression)
+    elif '.ckpt' in os.path.basename(args.dst):
+        tflex.write_snapshot(args.dst, items(names, progress=True))
+    elif args.dst.endswith('.hdf5'):
+        tflex.write_variables(args.dst, items(names, progress=True), compression=args.compression)
+    elif args.dst.endswith('.tensors'):
+        tflex.write_tensors(args.dst, items(names, progress=True))
+    else:
+        sys.exit('Unknown output format for %s; use .hdf5, .shards.json, .tensors or .ckpt' % args.dst)
+    reader.close()
+    if like:
+        like.close()
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,15 @@
 # Usage:
 #  PYTHONPATH=src ./encode.py <file|directory|glob> /path/to/output.npz
 #  PYTHONPATH=src ./train --dataset /path/to/output.npz
+#
+# If the output path ends in .tok, a flat uint16 token file plus a .tok.idx
+# chunk index is written instead, which train.py memory-maps.
 
 import argparse
 import numpy as np
 
 import encoder
-from load_dataset import load_dataset
+from load_dataset import load_dataset, save_tokens
 
 parser = argparse.ArgumentParser(
     description='Pre-encode text files into tokenized training set.',
@@ -15,7 +18,7 @@ parser = argparse.ArgumentParser(
 parser.add_argument('--model_name', metavar='MODEL', type=str, default='117M', help='Pretrained model name')
 parser.add_argument('--combine', metavar='CHARS', type=int, default=50000, help='Concatenate files with <|endoftext|> separator into chunks of this minimum size')
 parser.add_argument('in_text', metavar='PATH', type=str, help='Input file, directory, or glob pattern (utf-8 text).')
-parser.add_argument('out_npz', metavar='OUT.npz', type=str, help='Output file path')
+parser.add_argument('out_npz', metavar='OUT.npz', type=str, help='Output file path (.npz, or .tok for a memory-mappable token file)')
 
 def main():
     args = parser.parse_args()
@@ -23,7 +26,10 @@ def main():
     print('Reading files')
     chunks = load_dataset(enc, args.in_text, args.combine)
     print('Writing', args.out_npz)
-    np.savez_compressed(args.out_npz, *chunks)
+    if args.out_npz.endswith('.tok'):
+        save_tokens(args.out_npz, chunks)
+    else:
+        np.savez_compressed(args.out_npz, *chunks)
 
 
 if __name__ == '__main__':
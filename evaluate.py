@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Usage:
+#  PYTHONPATH=src ./evaluate.py --model_name 117M heldout.tok
+#  PYTHONPATH=src ./evaluate.py --restore_from checkpoint/run1 --batch_size 32 --overlap 512 heldout.tok
+#
+# Scores every token of a pre-encoded dataset (.tok, .npz or a directory of
+# them) once, except the first, which has no context, and reports the
+# per-token loss, perplexity and throughput.
+#
+# The dataset is read as one token stream, split into --batch_size contiguous
+# streams that are evaluated side by side. Each stream after the first also
+# reads the --overlap tokens before it, unscored, as context for its first
+# tokens. Each stream is walked in windows of
+# at most --n_ctx tokens. A window starts with up to --overlap tokens of
+# context that were already scored, followed by --stride new tokens, and is
+# then extended --stride tokens at a time by feeding the model's `past` back
+# in (kept on the device between calls) until it is full. So every scored
+# token sees at least --overlap tokens of context, and only the overlap is
+# recomputed when a new window starts.
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path += [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')]
+
+import numpy as np
+import tensorflow as tf
+import tqdm
+
+import model, encoder
+from load_dataset import load_dataset, load_tokens
+import tflex
+
+parser = argparse.ArgumentParser(
+    description='Compute the loss and perplexity of a model on a pre-encoded dataset.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('dataset', metavar='PATH', type=str, help='Pre-encoded dataset (.tok, .npz, or a directory of them).')
+parser.add_argument('--model_name', metavar='MODEL', type=str, default='117M', help='Pretrained model name (for hparams.json and the encoder).')
+parser.add_argument('--restore_from', type=str, default=None, help='Checkpoint or checkpoint directory to evaluate (default: models/<model_name>).')
+parser.add_argument('--batch_size', metavar='SIZE', type=int, default=8, help='Number of streams evaluated side by side.')
+parser.add_argument('--n_ctx', type=int, default=-1, help='Window size in tokens. Defaults to the model\'s n_ctx.')
+parser.add_argument('--overlap', type=int, default=-1, help='Minimum tokens of context for each scored token. Defaults to n_ctx/2.')
+parser.add_argument('--stride', type=int, default=-1, help='Tokens fed per session call. Defaults to n_ctx - overlap, one call per window.')
+parser.add_argument('--max_tokens', type=int, default=0, help='Only evaluate the first N tokens of the dataset. Disabled if set <= 0')
+parser.add_argument('--combine', metavar='CHARS', type=int, default=50000, help='Concatenate files with <|endoftext|> separator into chunks of this minimum size (for raw text in a directory)')
+parser.add_argument('--dtype', type=str, default='float32', help='Model dtype <float32|float16|bfloat16>.')
+parser.add_argument('--output', type=str, default=None, help='Also write the results to this JSON file.')
+
+def load_stream(path, model_name, combine):
+    """Return the dataset as one flat token array (memory-mapped for .tok)."""
+    if path.endswith('.tok'):
+        tokens, _ = load_tokens(path)
+        return tokens
+    enc = encoder.get_encoder(model_name)
+    return np.concatenate(load_dataset(enc, path, combine))
+
+def stream_starts(length, count, overlap):
+    """Split `length` tokens into `count` contiguous streams.
+
+    Returns (starts, lo, hi, size): stream i reads `size` tokens from
+    starts[i], and scores the tokens lo[i]..hi[i]. Each stream but the first
+    starts up to `overlap` (at least 1) tokens before the tokens it scores,
+    so its first scored token has context; the first token of the data is
+    never scored."""
+    n = -(-length // count)
+    context = max(1, min(overlap, n))
+    lo = np.arange(count) * n
+    hi = np.minimum(lo + n, length)
+    starts = np.maximum(0, lo - context)
+    lo = np.maximum(lo, 1)
+    return starts, lo, hi, n + context
+
+def stream_slice(tokens, starts, begin, end):
+    """Return tokens begin..end of each stream (relative to its start) as a
+    [len(starts), end - begin] int32 array, zero padded past the end of the
+    data. Only the slice is read, so `tokens` can be a memmap."""
+    out = np.zeros([len(starts), end - begin], dtype=np.int32)
+    for i, start in enumerate(starts):
+        part = tokens[min(len(tokens), start + begin):min(len(tokens), start + end)]
+        out[i, :len(part)] = part
+    return out
+
+def build_eval(hparams, batch_size):
+    """Build the graph for scoring a window from scratch and for extending it with the saved past."""
+    tokens = tf.placeholder(tf.int32, [batch_size, None])
+    targets = tf.placeholder(tf.int32, [batch_size, None])
+    weights = tf.placeholder(tf.float32, [batch_size, None])
+    past_shape = model.past_shape(hparams=hparams, batch_size=batch_size)
+    empty = np.zeros(past_shape[:-2] + [0, past_shape[-1]], dtype=hparams.dtype.as_numpy_dtype)
+    past_var = tf.Variable(empty, trainable=False, validate_shape=False, name='eval_past',
+                           collections=[tf.GraphKeys.LOCAL_VARIABLES])
+    past = tf.identity(past_var)
+    past.set_shape(past_shape)
+
+    def score(output, present):
+        logits = tf.cast(output['logits'], tf.float32)
+        losses = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=targets, logits=logits)
+        with tf.control_dependencies([tf.assign(past_var, present, validate_shape=False)]):
+            return tf.reduce_sum(losses * weights), tf.reduce_sum(weights)
+
+    start = model.model(hparams=hparams, X=tokens)
+    extend = model.model(hparams=hparams, X=tokens, past=past)
+    return {
+        'tokens': tokens,
+        'targets': targets,
+        'weights': weights,
+        'start': score(start, start['present']),
+        'extend': score(extend, tf.concat([past, extend['present']], axis=-2)),
+    }
+
+def windows(length, n_ctx, overlap, stride):
+    """Yield (kind, begin, end, scored_from) for the inputs of a stream of `length` inputs.
+
+    Inputs begin..end are fed; the predictions of inputs scored_from..end are
+    scored. `kind` is 'start' for a fresh window and 'extend' to continue the
+    previous one from its past."""
+    pos = 0
+    past = 0
+    while pos < length:
+        if past == 0 or past + stride > n_ctx:
+            context = min(overlap, pos)
+            end = min(length, pos + stride)
+            yield 'start', pos - context, end, pos
+            past = end - (pos - context)
+        else:
+            end = min(length, pos + stride)
+            yield 'extend', pos, end, pos
+            past += end - pos
+        pos = end
+
+def main():
+    args = parser.parse_args()
+    hparams = model.default_hparams()
+    with open(os.path.join('models', args.model_name, 'hparams.json')) as f:
+        hparams.override_from_dict(json.load(f))
+    hparams.dtype = tf.as_dtype(args.dtype)
+    n_ctx = hparams.n_ctx if args.n_ctx <= 0 else min(args.n_ctx, hparams.n_ctx)
+    overlap = n_ctx // 2 if args.overlap < 0 else args.overlap
+    stride = n_ctx - overlap if args.stride <= 0 else args.stride
+    if overlap + stride > n_ctx:
+        sys.exit('--overlap + --stride must be at most n_ctx ({})'.format(n_ctx))
+
+    tokens = load_stream(args.dataset, args.model_name, args.combine)
+    if args.max_tokens > 0:
+        tokens = tokens[:args.max_tokens]
+    starts, lo, hi, size = stream_starts(len(tokens), args.batch_size, overlap)
+    # Input i of a stream predicts token i + 1, so a stream of n tokens has n - 1 inputs.
+    inputs = max(0, size - 1)
+    print('Evaluating {} tokens as {} streams of {} (n_ctx={}, overlap={}, stride={})'.format(
+        len(tokens), args.batch_size, inputs, n_ctx, overlap, stride))
+
+    with tflex.Session(graph=tf.Graph()) as sess:
+        ops = build_eval(hparams, args.batch_size)
+        saver = tflex.Saver(var_list=[v for v in tf.trainable_variables() if 'model' in v.name])
+        restore_from = args.restore_from or os.path.join('models', args.model_name)
+        ckpt = tflex.latest_checkpoint(restore_from) or restore_from
+        print('Loading snapshot %s...' % ckpt)
+        sess.run(tf.local_variables_initializer())
+        saver.restore(sess, ckpt)
+
+        total_loss = 0.0
+        total_count = 0.0
+        start_time = time.time()
+        plan = list(windows(inputs, n_ctx, overlap, stride))
+        for kind, begin, end, scored_from in tqdm.tqdm(plan):
+            batch = stream_slice(tokens, starts, begin, end + 1)
+            # Only score the targets that belong to each stream.
+            targets = starts[:, None] + np.arange(begin, end)[None, :] + 1
+            weights = ((targets >= lo[:, None]) & (targets < hi[:, None])).astype(np.float32)
+            weights[:, :scored_from - begin] = 0.0
+            loss_sum, count = sess.run(ops[kind], feed_dict={
+                ops['tokens']: batch[:, :-1],
+                ops['targets']: batch[:, 1:],
+                ops['weights']: weights,
+            })
+            total_loss += loss_sum
+            total_count += count
+        elapsed = time.time() - start_time
+
+    loss = total_loss / max(1.0, total_count)
+    results = {
+        'dataset': args.dataset,
+        'checkpoint': ckpt,
+        'tokens': int(total_count),
+        'loss': loss,
+        'perplexity': float(np.exp(loss)),
+        'secs': elapsed,
+        'tokens_per_sec': total_count / elapsed,
+        'n_ctx': n_ctx,
+        'overlap': overlap,
+        'stride': stride,
+    }
+    print('loss={loss:2.4f} perplexity={perplexity:2.4f} tokens={tokens} in {secs:2.2f}s ({tokens_per_sec:2.2f}tokens/s)'.format(**results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,9 @@ class AccumulatingOptimizer(object):
         self.total_loss = tf.Variable(tf.zeros(shape=[], dtype=tf.float32))
         self.count_loss = tf.Variable(tf.zeros(shape=[], dtype=tf.float32))
 
+    def variables(self):
+        return list(self.accum_vars.values()) + [self.total_loss, self.count_loss] + self.opt.variables()
+
     def reset(self):
         updates = [tv.assign(tf.zeros_like(tv)) for tv in self.accum_vars.values()]
         updates.append(self.total_loss.assign(tf.zeros(shape=[], dtype=tf.float32)))
@@ -30,7 +33,7 @@ class AccumulatingOptimizer(object):
         with tf.control_dependencies(updates):
             return tf.no_op()
 
-    def apply_gradients(self):
+    def apply_gradients(self, global_step=None):
         grads = [(g,v) for (v,g) in self.accum_vars.items()]
-        with tf.control_dependencies([self.opt.apply_gradients(grads)]):
+        with tf.control_dependencies([self.opt.apply_gradients(grads, global_step=global_step)]):
             return self.total_loss / self.count_loss
@@ -5,7 +5,8 @@ import tensorflow as tf
 import tqdm
 
 
-def load_dataset(enc, path, combine):
+def dataset_paths(path):
+    """Return the data files of a file, directory or glob pattern."""
     paths = []
     if os.path.isfile(path):
         # Simple file
@@ -19,28 +20,163 @@ def load_dataset(enc, path, combine):
         # Assume glob
         paths = glob.glob(path)
 
+    # Indexes of flat token files and raw text files (and text indexes saved
+    # by older versions as .index.npz); they are not data.
+    return [path for path in paths if not path.endswith(('.tok.idx', TEXT_INDEX_SUFFIX, '.index.npz'))]
+
+
+def load_dataset(enc, path, combine, shard_index=0, shard_count=1):
+    """Load a dataset as a list of token chunks.
+
+    With shard_count > 1, only shard `shard_index` is loaded: every
+    shard_count-th file if there are at least shard_count files, otherwise
+    every shard_count-th chunk (or a 1/shard_count token range) of each file.
+    .npz items that don't overlap the shard are never read, and .tok files
+    are memory-mapped, so workers on one node share their pages."""
+    paths = dataset_paths(path)
+    if shard_count > 1:
+        paths = sorted(paths)
+        if len(paths) >= shard_count:
+            paths = paths[shard_index::shard_count]
+            shard_index, shard_count = 0, 1
+
     token_chunks = []
-    raw_text = ''
+    text_chunks = []
+    text_tokens = []
+    text_size = 0
     for path in tqdm.tqdm(paths):
-        if path.endswith('.npz'):
+        if path.endswith('.tok'):
+            # Pre-encoded flat token file
+            tokens, boundaries = load_tokens(path)
+            chunks = [tokens[boundaries[i]:boundaries[i + 1]] for i in range(len(boundaries) - 1)]
+            token_chunks.extend(shard_chunks(chunks, shard_index, shard_count))
+        elif path.endswith('.npz'):
             # Pre-encoded
             with np.load(path) as npz:
-                for item in npz.files:
-                    token_chunks.append(npz[item])
+                items = npz.files
+                if shard_count <= 1:
+                    token_chunks.extend([npz[item] for item in items])
+                else:
+                    # Only read the items that overlap the shard.
+                    lengths = [npz_item_shape(npz, item)[0] for item in items]
+                    token_chunks.extend([npz[items[i]][start:end] for i, start, end in shard_slices(lengths, shard_index, shard_count)])
         else:
             # Plain text
             with open(path, 'r') as fp:
-                raw_text += fp.read()
-            if len(raw_text) >= combine:
-                tokens = np.stack(enc.encode(raw_text))
-                token_chunks.append(tokens)
-                raw_text = ''
-            else:
-                raw_text += '<|endoftext|>'
-    if raw_text:
-        tokens = np.stack(enc.encode(raw_text))
-        token_chunks.append(tokens)
-    return token_chunks
+                raw_text = fp.read()
+            if text_tokens:
+                text_tokens.append(enc.encoder['<|endoftext|>'])
+            text_tokens.extend(encode_text(enc, raw_text))
+            text_size += len(raw_text)
+            if text_size >= combine:
+                text_chunks.append(np.array(text_tokens, dtype=np.int32))
+                text_tokens = []
+                text_size = 0
+    if text_tokens:
+        text_chunks.append(np.array(text_tokens, dtype=np.int32))
+    return token_chunks + shard_chunks(text_chunks, shard_index, shard_count)
+
+
+def encode_text(enc, text):
+    """Encode text, with each literal <|endoftext|> as the end-of-text token.
+
+    The encoders treat '<|endoftext|>' as ordinary text, which would leave no
+    document boundaries in the encoded dataset."""
+    eot = enc.encoder['<|endoftext|>']
+    tokens = []
+    for i, part in enumerate(text.split('<|endoftext|>')):
+        if i > 0:
+            tokens.append(eot)
+        tokens.extend(enc.encode(part))
+    return tokens
+
+
+def shard_slices(lengths, index, count):
+    """Return shard `index` of `count` of chunks of the given lengths, as
+    (chunk, start, end) triples: every count-th chunk if there are enough of
+    them, otherwise a contiguous 1/count of the tokens."""
+    if len(lengths) >= count:
+        return [(i, 0, lengths[i]) for i in range(index, len(lengths), count)]
+    boundaries = np.zeros(len(lengths) + 1, dtype=np.int64)
+    boundaries[1:] = np.cumsum(lengths)
+    lo, hi = shard_range(int(boundaries[-1]), index, count)
+    result = []
+    for i in range(len(lengths)):
+        start, end = max(lo, boundaries[i]), min(hi, boundaries[i + 1])
+        if end > start:
+            result.append((i, int(start - boundaries[i]), int(end - boundaries[i])))
+    return result
+
+
+def shard_chunks(chunks, index, count):
+    """Return shard `index` of `count` of a list of chunks (see shard_slices)."""
+    if count <= 1:
+        return chunks
+    return [chunks[i][start:end] for i, start, end in shard_slices([chunk.shape[0] for chunk in chunks], index, count)]
+
+
+def npz_item_shape(npz, item):
+    """Return the shape of an item of an open .npz file from its header, without reading it."""
+    with npz.zip.open(item + '.npy') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, _, _ = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    return shape
+
+
+def save_tokens(path, chunks):
+    """Write chunks as one flat uint16 token file plus a boundaries index.
+
+    The tokens go to `path` and the chunk boundaries (an int64 array of
+    len(chunks) + 1 offsets, in tokens) go to `path + '.idx'`."""
+    boundaries = np.zeros(len(chunks) + 1, dtype=np.int64)
+    with open(path + '.tmp', 'wb') as f:
+        for i, chunk in enumerate(chunks):
+            chunk = np.asarray(chunk)
+            if chunk.size > 0 and chunk.max() >= 2**16:
+                raise ValueError('Token {} does not fit in uint16'.format(chunk.max()))
+            f.write(chunk.astype(np.uint16).tobytes())
+            boundaries[i + 1] = boundaries[i] + chunk.shape[0]
+    with open(path + '.idx.tmp', 'wb') as f:
+        np.save(f, boundaries)
+    os.rename(path + '.idx.tmp', path + '.idx')
+    os.rename(path + '.tmp', path)
+    return boundaries
+
+
+def load_tokens(path):
+    """Memory-map a flat token file written by save_tokens.
+
+    Returns (tokens, boundaries); chunk i is tokens[boundaries[i]:boundaries[i+1]]."""
+    boundaries = np.load(path + '.idx')
+    if boundaries[-1] == 0:
+        return np.zeros([0], dtype=np.uint16), boundaries
+    tokens = np.memmap(path, dtype=np.uint16, mode='r', shape=(int(boundaries[-1]),))
+    return tokens, boundaries
+
+
+def batch_buffer(owner, batch_size, length, out=None):
+    """Return `out`, or a [batch_size, length] int32 buffer cached on `owner`."""
+    if out is not None:
+        return out
+    buf = getattr(owner, 'batch', None)
+    if buf is None or buf.shape != (batch_size, length):
+        buf = np.empty([batch_size, length], dtype=np.int32)
+        owner.batch = buf
+    return buf
+
+
+def get_rng_state(rs):
+    """Return the state of a RandomState as a dict of numpy values."""
+    _, keys, pos, has_gauss, cached_gaussian = rs.get_state()
+    return {'rng_keys': keys, 'rng_pos': pos, 'rng_has_gauss': has_gauss, 'rng_cached_gaussian': cached_gaussian}
+
+
+def set_rng_state(rs, state):
+    rs.set_state(('MT19937', np.asarray(state['rng_keys'], dtype=np.uint32), int(state['rng_pos']),
+                  int(state['rng_has_gauss']), float(state['rng_cached_gaussian'])))
 
 
 def binary_search(f, lo, hi):
@@ -55,32 +191,207 @@ def binary_search(f, lo, hi):
     return hi
 
 
+def shard_range(total_size, index, count):
+    """Return the [lo, hi) token range of shard `index` out of `count` equal shards."""
+    return total_size * index // count, total_size * (index + 1) // count
+
+
 class Sampler(object):
     """Fairly samples a slice from a set of variable sized chunks.
 
     'Fairly' means that the distribution is the same as sampling from one concatenated chunk,
-    but without crossing chunk boundaries."""
+    but without crossing chunk boundaries.
+
+    Rather than drawing an index and retrying when the slice crosses a boundary,
+    each chunk is weighted by its number of valid start positions, so a draw
+    never has to be rejected no matter how skewed the chunk sizes are."""
 
     def __init__(self, chunks, seed=None):
         self.chunks = chunks
-        self.total_size = sum(chunk.shape[0] for chunk in chunks)
-        self.boundaries = [0]
-        for i in range(len(chunks)):
-            self.boundaries.append(self.boundaries[-1] + chunks[i].shape[0])
+        self.chunk_count = len(chunks)
+        self.boundaries = np.zeros(len(chunks) + 1, dtype=np.int64)
+        self.boundaries[1:] = np.cumsum([chunk.shape[0] for chunk in chunks])
+        self.total_size = int(self.boundaries[-1])
         self.rs = np.random.RandomState(seed=seed)
+        self.starts = {}
+
+    def get_state(self):
+        return get_rng_state(self.rs)
+
+    def set_state(self, state):
+        set_rng_state(self.rs, state)
+
+    def start_counts(self, length):
+        """Return (counts, cumulative counts) of valid start positions per chunk."""
+        if length not in self.starts:
+            counts = np.maximum(np.diff(self.boundaries) - length, 0)
+            self.starts[length] = (counts, np.cumsum(counts))
+        return self.starts[length]
+
+    def sample_starts(self, length, n=None):
+        """Draw (chunk indices, offsets within chunk) for n slices of `length` tokens.
+
+        Returns scalars if n is None, otherwise arrays of shape [n]."""
+        counts, cumulative = self.start_counts(length)
+        assert cumulative[-1] > 0, \
+            "Dataset files are too small to sample {} tokens at a time".format(length)
+        r = self.rs.randint(0, cumulative[-1], size=n, dtype=np.int64)
+        i = np.searchsorted(cumulative, r, side='right')
+        return i, r - (cumulative[i] - counts[i])
 
     def sample(self, length):
-        assert length < self.total_size // len(
-            self.chunks
-        ), "Dataset files are too small to sample {} tokens at a time".format(
-            length)
-        while True:
-            index = self.rs.randint(0, self.total_size - length - 1)
-            i = binary_search(lambda j: self.boundaries[j] > index, 0,
-                              len(self.boundaries) - 1) - 1
-            if self.boundaries[i + 1] > index + length:
-                within_chunk = index - self.boundaries[i]
-                return self.chunks[i][within_chunk:within_chunk + length]
+        i, within_chunk = self.sample_starts(length)
+        return self.chunks[i][within_chunk:within_chunk + length]
+
+    def shard(self, index, count):
+        """Only sample from shard `index` of `count`: a contiguous 1/count of the
+        tokens, cut at chunk boundaries. The chunks are sliced, not copied."""
+        lo, hi = shard_range(self.total_size, index, count)
+        chunks = []
+        for i, chunk in enumerate(self.chunks):
+            start, end = max(lo, self.boundaries[i]), min(hi, self.boundaries[i + 1])
+            if end > start:
+                chunks.append(chunk[start - self.boundaries[i]:end - self.boundaries[i]])
+        self.chunks = chunks
+        self.chunk_count = len(chunks)
+        self.boundaries = np.zeros(len(chunks) + 1, dtype=np.int64)
+        self.boundaries[1:] = np.cumsum([chunk.shape[0] for chunk in chunks])
+        self.total_size = int(self.boundaries[-1])
+        self.starts = {}
+        return self
+
+    def sample_batch(self, batch_size, length, out=None):
+        """Sample batch_size slices into one contiguous [batch_size, length] int32 array.
+
+        Unless `out` is given, the same buffer is reused from call to call, so
+        the previous batch must be consumed before the next one is sampled."""
+        out = batch_buffer(self, batch_size, length, out)
+        chunks, offsets = self.sample_starts(length, batch_size)
+        for row, (i, within_chunk) in enumerate(zip(chunks, offsets)):
+            out[row] = self.chunks[i][within_chunk:within_chunk + length]
+        return out
+
+
+class MemmapSampler(Sampler):
+    """Samples like Sampler, but from a flat token file written by save_tokens.
+
+    The tokens are memory-mapped instead of loaded, so startup doesn't depend
+    on the dataset size, and processes sampling the same file share the page
+    cache."""
+
+    def __init__(self, path, seed=None):
+        self.path = path
+        self.tokens, self.boundaries = load_tokens(path)
+        self.chunk_count = len(self.boundaries) - 1
+        self.total_size = int(self.boundaries[-1])
+        self.rs = np.random.RandomState(seed=seed)
+        self.starts = {}
+
+    def sample(self, length):
+        i, within_chunk = self.sample_starts(length)
+        index = self.boundaries[i] + within_chunk
+        return self.tokens[index:index + length].astype(np.int32)
+
+    def shard(self, index, count):
+        # Chunks are ranges of the flat token file, so clipping the
+        # boundaries to the shard's range is enough.
+        lo, hi = shard_range(self.total_size, index, count)
+        lo, hi = lo + self.boundaries[0], hi + self.boundaries[0]
+        self.boundaries = np.unique(np.clip(self.boundaries, lo, hi))
+        self.chunk_count = len(self.boundaries) - 1
+        self.total_size = int(self.boundaries[-1] - self.boundaries[0])
+        self.starts = {}
+        return self
+
+    def sample_batch(self, batch_size, length, out=None):
+        out = batch_buffer(self, batch_size, length, out)
+        chunks, offsets = self.sample_starts(length, batch_size)
+        index = self.boundaries[chunks] + offsets
+        out[...] = self.tokens[index[:, None] + np.arange(length)]
+        return out
+
+class PackedSampler(object):
+    """Samples rows of whole documents packed end to end, with a segment id per token.
+
+    Documents are split at `eot` tokens (kept at the end of each document) and
+    at chunk boundaries, then cut into pieces of at most `max_length` tokens.
+    Each row of a batch is filled with randomly drawn pieces, each starting at
+    its document's start, until it is full; the piece that doesn't fit is cut
+    off at the end of the row, so no row is padded. Pieces are drawn in
+    proportion to their length, so every token is as likely to be trained on
+    as with Sampler.
+
+    sample_batch returns (tokens, segments): segments numbers the pieces of
+    each row 1, 2, ..., so the model can keep attention within a piece and
+    restart positions at each one."""
+
+    def __init__(self, chunks, eot, max_length=1024, seed=None, block_size=1 << 24):
+        self.chunks = chunks
+        pieces = [np.zeros([0, 3], dtype=np.int64)]
+        for i, chunk in enumerate(chunks):
+            # Scan in blocks, so a memory-mapped chunk is never loaded whole.
+            ends = [np.flatnonzero(np.asarray(chunk[j:j + block_size]) == eot) + (j + 1)
+                    for j in range(0, chunk.shape[0], block_size)]
+            ends = np.concatenate(ends + [[chunk.shape[0]]]).astype(np.int64)
+            starts = np.concatenate([[0], ends[:-1]])
+            counts = -(-(ends - starts) // max_length)
+            doc = np.repeat(np.arange(len(starts)), counts)
+            first = np.repeat(np.cumsum(counts) - counts, counts)
+            piece_starts = starts[doc] + (np.arange(len(doc)) - first) * max_length
+            piece_ends = np.minimum(ends[doc], piece_starts + max_length)
+            pieces.append(np.stack([np.full_like(piece_starts, i), piece_starts, piece_ends], axis=1))
+        self.set_pieces(np.concatenate(pieces))
+        self.rs = np.random.RandomState(seed=seed)
+
+    def set_pieces(self, pieces):
+        self.pieces = pieces
+        self.cumulative = np.cumsum(pieces[:, 2] - pieces[:, 1])
+        self.total_size = int(self.cumulative[-1]) if len(pieces) > 0 else 0
+        self.chunk_count = len(pieces)
+
+    def get_state(self):
+        return get_rng_state(self.rs)
+
+    def set_state(self, state):
+        set_rng_state(self.rs, state)
+
+    def piece(self, i):
+        chunk, start, end = self.pieces[i]
+        return self.chunks[chunk][start:end]
+
+    def draw(self, n=None):
+        assert self.total_size > 0, "Dataset is empty"
+        r = self.rs.randint(0, self.total_size, size=n, dtype=np.int64)
+        return np.searchsorted(self.cumulative, r, side='right')
+
+    def sample(self, length):
+        return self.piece(self.draw())[:length]
+
+    def shard(self, index, count):
+        """Only sample from shard `index` of `count`: the pieces starting in a
+        contiguous 1/count of the tokens."""
+        lo, hi = shard_range(self.total_size, index, count)
+        starts = self.cumulative - (self.pieces[:, 2] - self.pieces[:, 1])
+        self.set_pieces(self.pieces[(starts >= lo) & (starts < hi)])
+        return self
+
+    def sample_batch(self, batch_size, length, out=None):
+        """Return (tokens, segments), two [batch_size, length] int32 arrays.
+
+        Unless `out` is given, the tokens buffer is reused from call to call."""
+        out = batch_buffer(self, batch_size, length, out)
+        segments = np.empty([batch_size, length], dtype=np.int32)
+        for row in range(batch_size):
+            pos = 0
+            segment = 1
+            while pos < length:
+                tokens = self.piece(self.draw())[:length - pos]
+                out[row, pos:pos + len(tokens)] = tokens
+                segments[row, pos:pos + len(tokens)] = segment
+                pos += len(tokens)
+                segment += 1
+        return out, segments
+
 
 def contbyte(b):
   n = ord(b)
@@ -135,10 +446,90 @@ def grab_tokens(f, enc, n):
   # dataset).
   return tokens[3:], line
 
+def build_text_index(fp, enc, stride=1024, block_size=1 << 24, probes=16, probe_size=1 << 14):
+  """Scan a raw utf-8 text file once for places a sample may start.
+
+  The file is split into `stride`-byte buckets, and each bucket contributes
+  its first line start, or failing that its first space, so every offset lies
+  on a character boundary at the start of a word. Also estimates the number
+  of bytes per token by encoding `probes` evenly spaced blocks of the file.
+  Returns (offsets, bytes_per_token)."""
+  fp.seek(0, 2)
+  total_size = fp.tell()
+  block_size -= block_size % stride
+  offsets = [np.zeros([1], dtype=np.int64)]
+  fp.seek(0, 0)
+  base = 0
+  with tqdm.tqdm(total=total_size, unit='B', unit_scale=True, desc='Indexing') as pbar:
+    while True:
+      block = fp.read(block_size)
+      if not block:
+        break
+      arr = np.frombuffer(block, dtype=np.uint8)
+      lines = np.flatnonzero(arr == ord('\n')) + (base + 1)
+      spaces = np.flatnonzero(arr == ord(' ')) + base
+      found = np.concatenate([lines, spaces])
+      priority = np.concatenate([np.zeros_like(lines), np.ones_like(spaces)])
+      order = np.lexsort((found, priority, found // stride))
+      found = found[order]
+      buckets = found // stride
+      offsets.append(found[np.r_[True, buckets[1:] != buckets[:-1]]] if len(found) else found)
+      base += len(block)
+      pbar.update(len(block))
+  offsets = np.concatenate(offsets)
+  offsets = offsets[offsets < total_size]
+  buckets = offsets // stride
+  offsets = offsets[np.r_[True, buckets[1:] != buckets[:-1]]]
+  nbytes = 0
+  ntokens = 0
+  for index in np.linspace(0, max(0, total_size - probe_size), probes).astype(np.int64):
+    fp.seek(int(index), 0)
+    block = fp.read(probe_size)
+    nbytes += len(block)
+    ntokens += len(enc.encode(block.decode('utf-8', errors='ignore')))
+  bytes_per_token = nbytes / max(1, ntokens)
+  return offsets, bytes_per_token
+
+TEXT_INDEX_SUFFIX = '.text.idx'
+
+def load_text_index(fp, enc, path=None):
+  """Load the index of a raw text file, building and saving it if needed.
+
+  The index is stored next to the file as `path + TEXT_INDEX_SUFFIX` (an npz
+  archive, named so load_dataset doesn't take it for data), and rebuilt
+  whenever the file's size or modification time changes."""
+  if path is None:
+    path = getattr(fp, 'name', None)
+  stat = os.stat(path) if isinstance(path, str) else None
+  index_path = path + TEXT_INDEX_SUFFIX if stat else None
+  if index_path and os.path.exists(index_path):
+    with np.load(index_path) as npz:
+      if npz['size'] == stat.st_size and npz['mtime'] == stat.st_mtime:
+        return npz['offsets'], float(npz['bytes_per_token'])
+  offsets, bytes_per_token = build_text_index(fp, enc)
+  if index_path:
+    try:
+      with open(index_path + '.tmp', 'wb') as f:
+        np.savez(f, offsets=offsets, bytes_per_token=bytes_per_token,
+                 size=stat.st_size, mtime=stat.st_mtime)
+      os.rename(index_path + '.tmp', index_path)
+    except OSError as e:
+      print('Could not save text index {}: {}'.format(index_path, e))
+  return offsets, bytes_per_token
+
 import threading
 
 class TextSampler(object):
-  def __init__(self, fp, enc, seed=None, verbose=False, use_locking=False):
+  """Samples token slices from a raw utf-8 text file, encoding on the fly.
+
+  With use_index, a one-time index of the file (see load_text_index) lets each
+  sample seek straight to the word boundary before a random byte, read one
+  block sized from the file's bytes-per-token ratio, and encode it once. The
+  indexed word boundary is only where encoding starts: the sample itself
+  starts at the first token at or after the random byte, so any token of the
+  file can start a sample."""
+
+  def __init__(self, fp, enc, seed=None, verbose=False, use_locking=False, use_index=True):
     if isinstance(fp, str):
       fp = open(fp, 'rb')
     self.fp = fp
@@ -148,6 +539,48 @@ class TextSampler(object):
     self.enc = enc
     self.verbose = verbose
     self.lock = threading.Lock() if use_locking else None
+    self.start, self.end = 0, self.total_size
+    self.offsets = None
+    if use_index:
+      self.offsets, self.bytes_per_token = load_text_index(fp, enc)
+      # Byte-level BPE: each vocab entry has one character per byte.
+      self.token_bytes = np.zeros([max(enc.encoder.values()) + 1], dtype=np.int64)
+      for token, i in enc.encoder.items():
+        self.token_bytes[i] = len(token)
+
+  def get_state(self):
+    return get_rng_state(self.rs)
+
+  def set_state(self, state):
+    set_rng_state(self.rs, state)
+
+  def shard(self, index, count):
+    """Only start samples in shard `index` of `count`: a contiguous 1/count of
+    the file's bytes. A sample may run past the end of the shard."""
+    self.start, self.end = shard_range(self.total_size, index, count)
+    return self
+
+  def grab(self, length):
+    index = self.rs.randint(self.start, self.end)
+    if self.offsets is None:
+      self.fp.seek(index, 0)
+      tokens, line = grab_tokens(self.fp, self.enc, length)
+      return tokens
+    start = int(self.offsets[np.searchsorted(self.offsets, index, side='right') - 1])
+    want = int(length * self.bytes_per_token * 1.25) + 64
+    while True:
+      self.fp.seek(start, 0)
+      block = self.fp.read(index - start + want)
+      text = block.decode('utf-8', errors='ignore').replace(u'\r', u'')
+      tokens = self.enc.encode(text)
+      # Skip the tokens that start before the random byte.
+      skip = len(block[:index - start].decode('utf-8', errors='ignore').replace(u'\r', u'').encode('utf-8'))
+      ends = np.cumsum(self.token_bytes[tokens]) if tokens else np.zeros([0], dtype=np.int64)
+      tokens = tokens[np.searchsorted(ends - self.token_bytes[tokens], skip):] if tokens else tokens
+      # The last token may have been cut off by the end of the block.
+      if len(tokens) > length or start + len(block) >= self.total_size:
+        return tokens
+      want *= 2
 
   def sample(self, length):
     try:
@@ -159,9 +592,7 @@ class TextSampler(object):
         if attempts > 10:
           print('Could not sample from dataset; too small?')
           return None
-        index = self.rs.randint(0, self.total_size)
-        self.fp.seek(index, 0)
-        tokens, line = grab_tokens(self.fp, self.enc, length)
+        tokens = self.grab(length)
         if len(tokens) >= length:
           if self.verbose:
             line = self.enc.decode(tokens)
@@ -171,3 +602,91 @@ class TextSampler(object):
       if self.lock:
         self.lock.release()
 
+  def sample_batch(self, batch_size, length, out=None):
+    out = batch_buffer(self, batch_size, length, out)
+    for row in range(batch_size):
+      tokens = self.sample(length)
+      if tokens is None:
+        raise ValueError('Could not sample {} tokens from dataset'.format(length))
+      out[row] = tokens
+    return out
+
+
+import queue
+import time
+
+class Prefetcher(object):
+  """Samples batches on a background thread into a bounded queue.
+
+  Batches are produced by a single thread in order, so a seeded sampler
+  yields exactly the batches that calling sample_batch directly would.
+  `stall_time` accumulates how long get() had to wait for data, and
+  get_state() returns the sampler state as of the last batch returned by
+  get(), so resuming from it continues with the next unconsumed batch."""
+
+  def __init__(self, sampler, batch_size, length, depth=4):
+    self.sampler = sampler
+    self.batch_size = batch_size
+    self.length = length
+    self.queue = queue.Queue(maxsize=depth)
+    self.stall_time = 0.0
+    self.last_stall = 0.0
+    self.error = None
+    self.stopped = False
+    self.state = sampler.get_state()
+    self.peeked = None
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def run(self):
+    try:
+      while not self.stopped:
+        out = np.empty([self.batch_size, self.length], dtype=np.int32)
+        batch = self.sampler.sample_batch(self.batch_size, self.length, out=out)
+        self.put((batch, self.sampler.get_state()))
+    except Exception as e:
+      self.error = e
+      self.put(None)
+
+  def put(self, item):
+    while not self.stopped:
+      try:
+        self.queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def get(self):
+    start = time.time()
+    if self.peeked is not None:
+      (item,), self.peeked = self.peeked, None
+    else:
+      item = self.queue.get()
+    self.last_stall = time.time() - start
+    self.stall_time += self.last_stall
+    if item is None:
+      raise self.error
+    batch, self.state = item
+    return batch
+
+  def peek(self):
+    """Return the batch the next get() will return, without consuming it.
+
+    Use this rather than drawing from the sampler, which the prefetching
+    thread owns."""
+    if self.peeked is None:
+      self.peeked = (self.queue.get(),)
+    item, = self.peeked
+    if item is None:
+      raise self.error
+    return item[0]
+
+  def get_state(self):
+    return self.state
+
+  def depth(self):
+    return self.queue.qsize()
+
+  def stop(self):
+    self.stopped = True
+    self.thread.join()
@@ -16,12 +16,11 @@ def default_hparams():
 
 import os
 
+import tflex
+
 def get_variable(name):
     name = os.path.join(tf.get_variable_scope().name, name)
-    vs = tf.trainable_variables()
-    for x in vs:
-        if x.name.startswith(name + ':'):
-            return x
+    return tflex.variable_index().get(name + ':0')
 
 def shape_list(x):
     """Deal with dynamic shape in tensorflow cleanly."""
@@ -79,12 +78,18 @@ def attention_mask(nd, ns, *, dtype):
     m = i >= j - ns + nd
     return tf.cast(m, dtype)
 
+def segment_mask(segments, *, dtype):
+    """[batch, 1, sequence, sequence] mask of 1's where two tokens are in the same segment."""
+    m = tf.equal(segments[:, None, :, None], segments[:, None, None, :])
+    return tf.cast(m, dtype)
+
 
-def attn(x, scope, n_state, *, past, hparams):
+def attn(x, scope, n_state, *, past, hparams, segments=None):
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_head == 0
     if past is not None:
         assert past.shape.ndims == 5  # Should be [batch, 2, heads, sequence, features], where 2 is [k, v]
+        assert segments is None  # Packed sequences are only supported without a past
 
     def split_heads(x):
         # From [batch, sequence, features] to [batch, heads, sequence, features]
@@ -99,6 +104,9 @@ def attn(x, scope, n_state, *, past, hparams):
         _, _, nd, ns = shape_list(w)
         b = attention_mask(nd, ns, dtype=w.dtype)
         b = tf.reshape(b, [1, 1, nd, ns])
+        if segments is not None:
+            # Block-diagonal: tokens only attend within their own segment.
+            b = b * segment_mask(segments, dtype=w.dtype)
         w = w*b - tf.cast(65500 if w.dtype != tf.float32 else 1e10, w.dtype)*(1-b)
         return w
 
@@ -143,11 +151,11 @@ def dropout(x, pdrop=0.1, train=True):
         x = tf.nn.dropout(x, rate=pdrop)
     return x
 
-def block(x, scope, *, past, hparams):
+def block(x, scope, *, past, hparams, segments=None):
     dtype = hparams.dtype if hparams else tf.float32
     with tf.variable_scope(scope, dtype=dtype):
         nx = x.shape[-1].value
-        a, present = attn(norm(x, 'ln_1', hparams=hparams), 'attn', nx, past=past, hparams=hparams)
+        a, present = attn(norm(x, 'ln_1', hparams=hparams), 'attn', nx, past=past, hparams=hparams, segments=segments)
         x = x + a
         m = mlp(norm(x, 'ln_2', hparams=hparams), 'mlp', nx*4, hparams=hparams)
         x = x + m
@@ -167,8 +175,22 @@ def positions_for(tokens, past_length):
     nsteps = tf.shape(tokens)[1]
     return expand_tile(past_length + tf.range(nsteps), batch_size)
 
+def segment_positions(segments):
+    """Positions that restart at 0 at the start of each segment.
+
+    Segments are contiguous, so a token's position is its index minus the
+    number of earlier tokens in other segments."""
+    nsteps = tf.shape(segments)[1]
+    i = tf.range(nsteps)
+    earlier = i[None, :, None] > i[None, None, :]
+    other = tf.not_equal(segments[:, :, None], segments[:, None, :])
+    return i[None, :] - tf.reduce_sum(tf.cast(earlier & other, tf.int32), axis=2)
+
 
-def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE):
+def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE, segments=None):
+    """Build the model. `segments`, if given, is a [batch, sequence] int32
+    segment id per token of X (as from PackedSampler): attention stays within
+    each segment and positions restart at each one."""
     dtype = hparams.dtype if hparams else tf.float32
     with tf.variable_scope(scope, reuse=reuse, dtype=dtype):
         results = {}
@@ -179,14 +201,15 @@ def model(hparams, X, past=None, scope='model', reuse=tf.AUTO_REUSE):
         wte = get_variable('wte') or tf.get_variable('wte', [hparams.n_vocab, hparams.n_embd],
                              initializer=tf.random_normal_initializer(stddev=0.02, dtype=dtype))
         past_length = 0 if past is None else tf.shape(past)[-2]
-        h = tf.gather(wte, X) + tf.gather(wpe, positions_for(X, past_length))
+        positions = positions_for(X, past_length) if segments is None else segment_positions(segments)
+        h = tf.gather(wte, X) + tf.gather(wpe, positions)
 
         # Transformer
         presents = []
         pasts = tf.unstack(past, axis=1) if past is not None else [None] * hparams.n_layer
         assert len(pasts) == hparams.n_layer
         for layer, past in enumerate(pasts):
-            h, present = block(h, 'h%d' % layer, past=past, hparams=hparams)
+            h, present = block(h, 'h%d' % layer, past=past, hparams=hparams, segments=segments)
             if layer == 10:
                 tf.add_to_collection('checkpoints', h)
             presents.append(present)
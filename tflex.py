@@ -10,6 +10,13 @@ import h5py
 import shutil
 import tempfile
 import math
+import json
+import itertools
+import threading
+import weakref
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 from tensorflow.contrib import tpu
 from tensorflow.contrib.cluster_resolver import TPUClusterResolver
@@ -58,39 +65,54 @@ def split_by_params(vs, n=200e6, f=None):
   yield xs
 
 def latest_checkpoint(checkpoint_dir, latest_filename=None):
-  paths = [x for x in glob(os.path.join(checkpoint_dir, 'model-*.*')) if not x.endswith(".tmp")]
-  ctrs = np.array([[int(y) for y in re.findall(r'model-([0-9]+)(?:-[0-9]+)?[.](?:npy|hdf5)', x)] for x in paths]).flatten()
-  if len(ctrs) <= 0:
-    ckpt = tf.train.latest_checkpoint(checkpoint_dir, latest_filename=latest_filename)
-    return ckpt
-  ctr = ctrs.max()
-  return os.path.join(checkpoint_dir, 'model-{}').format(ctr)
+  """Return the newest complete checkpoint in checkpoint_dir.
 
-def truncate_value(variable, value, reshape=True):
-  if not reshape:
-    return value
-  shape = variable.shape.as_list()
+  Reads the directory's manifest (see update_manifest), skipping entries
+  whose files are missing or incomplete. Without a manifest, scans the
+  directory instead, then falls back to tf.train.latest_checkpoint."""
+  entries = read_manifest(checkpoint_dir)
+  if entries is not None:
+    for entry in sorted(entries, key=lambda x: x['step'], reverse=True):
+      prefix = os.path.join(checkpoint_dir, entry['prefix'])
+      if checkpoint_size(prefix) == entry['size']:
+        return prefix
+      print('Skipping incomplete checkpoint %s' % prefix)
+  for step, prefix in reversed(list_checkpoints(os.path.join(checkpoint_dir, 'model'), cleanup=False)):
+    try:
+      resolve_checkpoint(prefix)
+    except Exception:
+      continue
+    return prefix
+  return tf.train.latest_checkpoint(checkpoint_dir, latest_filename=latest_filename)
+
+def truncate_array(name, value, shape):
+  """Fit `value` to `shape`, truncating or tiling its flattened contents."""
   params = np.prod(shape)
   params2 = np.prod(value.shape)
   if params == params2:
     return value
   if params2 > params:
-    print('Truncating {} from shape {} to shape {}'.format(variable.name, value.shape, shape))
+    print('Truncating {} from shape {} to shape {}'.format(name, value.shape, shape))
     sys.stdout.flush()
-    value = np.array(value)
+    value = np.asarray(value)
     value = value.reshape([-1])
     value = value[0:params]
     value = value.reshape(shape)
   else:
-    print('Expanding {} from shape {} to shape {}'.format(variable.name, value.shape, shape))
+    print('Expanding {} from shape {} to shape {}'.format(name, value.shape, shape))
     sys.stdout.flush()
-    value = np.array(value)
+    value = np.asarray(value)
     value = value.reshape([-1])
     n = math.ceil(params / params2)
-    value = np.tile(value, n)
+    value = np.tile(value, n)[0:params]
     value = value.reshape(shape)
   return value
 
+def truncate_value(variable, value, reshape=True):
+  if not reshape:
+    return value
+  return truncate_array(variable.name, value, variable.shape.as_list())
+
 def grab_values(variables, reader, reshape=False):
   for variable in variables:
     name = variable.name.split(':')[0]
@@ -114,35 +136,133 @@ def load_snapshot(ckpt, session=None, var_list=None, reshape=False):
     values = [value for variable, value in grab_values(variables, reader, reshape=reshape)]
     assign_values(variables, values, session=session)
 
+variable_indexes = weakref.WeakKeyDictionary()
+
+def variable_index(graph=None):
+  """Return a {name: variable} dict of the graph's trainable variables.
+
+  The dict is cached per graph and extended with any variables created since
+  the last call, so it stays valid while the graph is being built."""
+  graph = graph or tf.get_default_graph()
+  vs = graph.get_collection_ref(tf.GraphKeys.TRAINABLE_VARIABLES)
+  index, count = variable_indexes.get(graph, ({}, 0))
+  if count > len(vs):
+    index, count = {}, 0
+  for x in vs[count:]:
+    index.setdefault(x.name, x)
+  variable_indexes[graph] = (index, len(vs))
+  return index
+
 def get_variable(name, var_list=None):
   name, num = name.split(':') if ':' in name else (name, '0')
   num = int(num)
-  name = os.path.join(tf.get_variable_scope().name, name)
-  vs = var_list or tf.trainable_variables()
-  for x in vs:
-      if x.name.startswith(name + ':%d' % num):
+  name = os.path.join(tf.get_variable_scope().name, name) + ':%d' % num
+  if not var_list:
+    return variable_index().get(name)
+  for x in var_list:
+      if x.name == name:
           return x
 
-def load_weights(ckpt, session=None, var_list=None, reshape=False):
+def variable_lookup(vs):
+  """Return a function mapping checkpoint names to variables in `vs`.
+
+  Like get_variable, names may omit the ':0' suffix and the current variable
+  scope, but the variables are indexed once instead of scanned per name."""
+  index = dict([(x.name, x) for x in vs])
+  scope = tf.get_variable_scope().name
+  def lookup(name):
+    name = name if ':' in name else name + ':0'
+    if name in index:
+      return index[name]
+    return index.get(os.path.join(scope, name))
+  return lookup
+
+def load_pairs(pairs, session=None, reshape=False):
+  """Assign (variable, value) pairs, one split_by_params group per session call."""
+  for group in split_by_params(pairs, f=lambda x: np.prod(x[0].shape.as_list())):
+    if len(group) > 0:
+      assign_values([x for x, _ in group], [truncate_value(x, value, reshape=reshape) for x, value in group], session=session)
+
+def load_weights(ckpt, session=None, var_list=None, reshape=False, verify=False):
+  """Load a .tensors file written by write_tensors, or legacy pickled -N.npy files."""
   session = session or tf.get_default_session()
   vs = var_list or tf.trainable_variables()
-  files = list(sorted(glob(ckpt + '-*.npy')))
-  for out in tqdm.tqdm(files):
-    for name, value in np.load(out, allow_pickle=True):
-      variable = get_variable(name)
-      if variable is None:
+  lookup = variable_lookup(vs)
+  def pairs(items):
+    for name, value in items:
+      variable = lookup(name)
+      if variable is not None:
+        yield variable, value
+      elif not name.startswith(STATE_PREFIX):
         print('Warning: variable %s not loaded' % name)
-      else:
-        value = truncate_value(variable, value, reshape=reshape)
-        variable.load(value, session)
+  if ckpt.endswith('.tensors'):
+    index = read_tensor_index(ckpt)
+    load_pairs(pairs((name, tensor_value(ckpt, entry, verify=verify)) for name, entry in tqdm.tqdm(index.items())), session=session, reshape=reshape)
+  else:
+    for out in tqdm.tqdm(list(sorted(glob(ckpt + '-*.npy')))):
+      load_pairs(pairs(np.load(out, allow_pickle=True)), session=session, reshape=reshape)
+
+def is_bfloat16(dtype):
+  return np.dtype(dtype).name == 'bfloat16'
+
+def cast_value(value, dtype=None):
+  """Cast floating point values to `dtype`, leaving everything else alone."""
+  value = np.asarray(value)
+  if dtype is not None and (value.dtype.kind == 'f' or is_bfloat16(value.dtype)):
+    value = value.astype(tf.as_dtype(dtype).as_numpy_dtype)
+  return value
+
+def encode_value(value, dtype=None):
+  """Return (array to store, dtype name) for writing `value` to hdf5.
+
+  Floating point values are cast to `dtype` if given. hdf5 has no bfloat16,
+  so bfloat16 values are stored as their raw uint16 bits."""
+  value = cast_value(value, dtype)
+  if is_bfloat16(value.dtype):
+    return value.view(np.uint16), 'bfloat16'
+  return value, value.dtype.name
+
+def checksum(value):
+  return zlib.crc32(np.ascontiguousarray(value))
 
-def load_variables(ckpt, session=None, var_list=None, reshape=False):
+def dataset_value(dset, path, verify=False):
+  """Return the contents of an hdf5 dataset, memory-mapped from `path` when possible.
+
+  Uncompressed, unchunked datasets are stored contiguously, so they can be
+  mapped directly instead of being copied into memory by h5py. With verify,
+  the value is checked against the crc32 recorded by write_variables."""
+  offset = dset.id.get_offset()
+  if offset is None or dset.chunks is not None or len(dset.shape) == 0 or dset.size == 0:
+    value = dset[()]
+  else:
+    value = np.memmap(path, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+  if verify and 'crc32' in dset.attrs and checksum(value) != dset.attrs['crc32']:
+    raise ValueError('Checksum mismatch for %s in %s' % (dset.name, path))
+  if dset.attrs.get('dtype') == 'bfloat16':
+    value = value.view(tf.bfloat16.as_numpy_dtype)
+  return value
+
+def load_variables(ckpt, session=None, var_list=None, reshape=False, threads=1, verify=False):
   session = session or tf.get_default_session()
   vs = var_list or tf.trainable_variables()
   with h5py.File(ckpt, "r") as f:
-    for variables in tqdm.tqdm(list(split_by_params(vs))):
-      values = [truncate_value(x, f[x.name], reshape=reshape)  for x in variables]
+    def load_group(variables):
+      start = time.time()
+      values = [truncate_value(x, dataset_value(f[x.name], ckpt, verify=verify), reshape=reshape) for x in variables]
       assign_values(variables, values, session=session)
+      elapsed = time.time() - start
+      nbytes = sum([value.nbytes for value in values])
+      tqdm.tqdm.write('Loaded %d variables (%.2f MB) in %.4fs (%.2f MB/s)' % (len(variables), nbytes / 1e6, elapsed, nbytes / 1e6 / max(elapsed, 1e-9)))
+    groups = list(split_by_params(vs))
+    if threads > 1:
+      # session.run releases the GIL while it copies the mapped values into
+      # the variables, so groups load concurrently.
+      with ThreadPoolExecutor(threads) as pool:
+        for _ in tqdm.tqdm(pool.map(load_group, groups), total=len(groups)):
+          pass
+    else:
+      for variables in tqdm.tqdm(groups):
+        load_group(variables)
 
 def maketree(path):
     try:
@@ -150,22 +270,409 @@ def maketree(path):
     except:
         pass
 
-def save_variables(ckpt, session=None, var_list=None):
+def fetch_variables(session, vs, progress=True):
+  """Yield (variable, value) pairs, reading one split_by_params group at a time."""
+  groups = list(split_by_params(vs))
+  for variables in tqdm.tqdm(groups) if progress else groups:
+    for variable, value in zip(variables, session.run(variables)):
+      yield variable, value
+
+def write_variables(ckpt, items, dtype=None, compression=None):
+  """Write (name, value) pairs to an hdf5 file, via a .tmp file renamed into place.
+
+  Values keep their own dtype unless `dtype` is given (e.g. float16 for
+  inference exports). `compression` is passed to h5py ('gzip', 'lzf', ...);
+  compressed datasets can't be memory-mapped on restore. Each dataset records
+  its crc32, and the crc32s are returned by name."""
+  maketree(os.path.dirname(ckpt))
+  fname = ckpt+'.tmp'
+  checksums = {}
+  with h5py.File(fname, "w") as f:
+    for name, value in items:
+      value, dtype_name = encode_value(value, dtype=dtype)
+      # h5py can't filter scalar or empty datasets.
+      dset = f.create_dataset(name, data=value, compression=compression if value.size > 0 and value.ndim > 0 else None)
+      dset.attrs['dtype'] = dtype_name
+      dset.attrs['crc32'] = checksums[name] = checksum(value)
+  print('Writing snapshot %s' % ckpt)
+  os.rename(ckpt+'.tmp', ckpt)
+  return checksums
+
+def save_variables(ckpt, session=None, var_list=None, dtype=None, compression=None):
     session = session or tf.get_default_session()
     vs = var_list or tf.trainable_variables()
-    maketree(os.path.dirname(ckpt))
-    fname = ckpt+'.tmp'
-    with h5py.File(fname, "w") as f:
-      for variables in tqdm.tqdm(list(split_by_params(vs))):
-        values = session.run(variables)
-        for value, variable in zip(values, variables):
-          name = variable.name
-          shape = variable.shape.as_list()
-          dtype = variable.dtype
-          dset = f.create_dataset(name, shape, dtype=np.float32)
-          dset[:] = value
-    print('Writing snapshot %s' % ckpt)
-    os.rename(ckpt+'.tmp', ckpt)
+    return write_variables(ckpt, ((variable.name, value) for variable, value in fetch_variables(session, vs)), dtype=dtype, compression=compression)
+
+TENSORS_ALIGN = 64
+
+def write_tensors(ckpt, items, dtype=None):
+  """Write (name, value) pairs to a .tensors file, via a .tmp file renamed into place.
+
+  The file is the raw bytes of each value, each block aligned to 64 bytes,
+  followed by a JSON index of {name: {dtype, shape, offset, crc32}} and the
+  index length as 8 little-endian bytes. Nothing is pickled, and every value
+  can be memory-mapped straight out of the file. Returns the crc32s by name."""
+  maketree(os.path.dirname(ckpt))
+  fname = ckpt+'.tmp'
+  index = {}
+  checksums = {}
+  with open(fname, 'wb') as f:
+    for name, value in items:
+      value, dtype_name = encode_value(value, dtype=dtype)
+      shape = list(value.shape)
+      value = np.ascontiguousarray(value)
+      f.write(b'\0' * (-f.tell() % TENSORS_ALIGN))
+      checksums[name] = checksum(value)
+      index[name] = {'dtype': dtype_name, 'shape': shape, 'offset': f.tell(), 'crc32': checksums[name]}
+      f.write(value.tobytes())
+    header = json.dumps(index).encode('utf8')
+    f.write(header)
+    f.write(np.array(len(header), dtype='<u8').tobytes())
+  print('Writing snapshot %s' % ckpt)
+  os.rename(ckpt+'.tmp', ckpt)
+  return checksums
+
+def read_tensor_index(path):
+  """Return the {name: {dtype, shape, offset, crc32}} index of a .tensors file."""
+  with open(path, 'rb') as f:
+    f.seek(-8, os.SEEK_END)
+    size = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+    f.seek(-8 - size, os.SEEK_END)
+    return json.loads(f.read(size).decode('utf8'))
+
+def tensor_value(path, entry, verify=False):
+  """Return a value from a .tensors file, memory-mapped where possible."""
+  bfloat16 = entry['dtype'] == 'bfloat16'
+  dtype = np.uint16 if bfloat16 else np.dtype(entry['dtype'])
+  shape = tuple(entry['shape'])
+  if np.prod(shape) == 0:
+    value = np.zeros(shape, dtype=dtype)
+  else:
+    value = np.memmap(path, dtype=dtype, mode='r', offset=entry['offset'], shape=shape)
+  if verify and checksum(value) != entry['crc32']:
+    raise ValueError('Checksum mismatch at offset %d in %s' % (entry['offset'], path))
+  if bfloat16:
+    value = value.view(tf.bfloat16.as_numpy_dtype)
+  return value
+
+def shard_variables(vs, shards):
+  """Partition vs into about `shards` groups of similar parameter count."""
+  total = sum([np.prod(v.shape.as_list()) for v in vs])
+  return [xs for xs in split_by_params(vs, n=max(1, math.ceil(total / shards))) if xs]
+
+def shard_path(prefix, i, count):
+  return '%s.%05d-of-%05d.hdf5' % (prefix, i, count)
+
+def write_sharded(prefix, groups, dtype=None, compression=None):
+  """Write each group of (name, value) pairs to its own hdf5 shard, concurrently.
+
+  The shards are tied together by `prefix + '.shards.json'`, which is
+  written last, so a checkpoint without a manifest is incomplete."""
+  paths = [shard_path(prefix, i, len(groups)) for i in range(len(groups))]
+  def write_shard(args):
+    return write_variables(args[0], args[1], dtype=dtype, compression=compression)
+  with ThreadPoolExecutor(len(groups)) as pool:
+    results = list(pool.map(write_shard, zip(paths, groups)))
+  checksums = {}
+  for result in results:
+    checksums.update(result)
+  manifest = {
+    'shards': [os.path.basename(path) for path in paths],
+    'variables': dict([(name, i) for i, result in enumerate(results) for name in result]),
+  }
+  fname = prefix + '.shards.json'
+  with open(fname + '.tmp', 'w') as f:
+    json.dump(manifest, f)
+  os.rename(fname + '.tmp', fname)
+  return checksums
+
+def load_sharded(manifest_path, session=None, var_list=None, reshape=False, threads=None, verify=False):
+  """Restore a checkpoint written by write_sharded, reading shards concurrently."""
+  session = session or tf.get_default_session()
+  vs = var_list or tf.trainable_variables()
+  with open(manifest_path) as f:
+    manifest = json.load(f)
+  shards = [[] for _ in manifest['shards']]
+  for variable in vs:
+    if variable.name not in manifest['variables']:
+      raise KeyError('Variable %s not found in %s' % (variable.name, manifest_path))
+    shards[manifest['variables'][variable.name]].append(variable)
+  dirname = os.path.dirname(manifest_path)
+  def load_shard(args):
+    shard, variables = args
+    load_variables(os.path.join(dirname, shard), session=session, var_list=variables, reshape=reshape, verify=verify)
+  work = [(shard, variables) for shard, variables in zip(manifest['shards'], shards) if variables]
+  with ThreadPoolExecutor(threads or max(1, len(work))) as pool:
+    list(pool.map(load_shard, work))
+
+def checkpoint_files(prefix):
+  """Return the files making up the checkpoint `prefix`, index files first.
+
+  Removing the index files first makes a checkpoint invisible to restore
+  before its data goes away."""
+  files = [x for x in glob(prefix + '.*') + glob(prefix + '-*.npy')]
+  return sorted(files, key=lambda x: (not (x.endswith('.shards.json') or x.endswith('.index')), x))
+
+def list_checkpoints(save_path, cleanup=True):
+  """Return [(step, prefix)] for the checkpoints saved under `save_path`, oldest first.
+
+  Zero-byte hdf5 files (left behind by older versions, which truncated old
+  checkpoints instead of deleting them) are skipped, and removed if cleanup."""
+  dirname, basename = os.path.split(save_path)
+  regex = re.compile(re.escape(basename) + r'-([0-9]+)(?:[.-]|$)')
+  found = {}
+  for path in glob(os.path.join(dirname, basename + '-*')):
+    m = regex.match(os.path.basename(path))
+    if m is None or path.endswith('.tmp'):
+      continue
+    if path.endswith('.hdf5') and os.path.getsize(path) == 0:
+      if cleanup:
+        print('Removing empty checkpoint file %s' % path)
+        try:
+          os.remove(path)
+        except OSError:
+          print('Failed to remove %s' % path)
+      continue
+    step = int(m.group(1))
+    found[step] = os.path.join(dirname, '%s-%d' % (basename, step))
+  return sorted(found.items())
+
+def checkpoint_size(prefix):
+  return sum([os.path.getsize(x) for x in checkpoint_files(prefix)])
+
+MANIFEST = 'checkpoints.json'
+
+def read_manifest(checkpoint_dir):
+  """Return the entries of checkpoint_dir's manifest, or None if it has none."""
+  try:
+    with open(os.path.join(checkpoint_dir, MANIFEST)) as f:
+      return json.load(f)['checkpoints']
+  except (IOError, OSError, ValueError, KeyError):
+    return None
+
+def update_manifest(checkpoint_dir, add=None, remove=()):
+  """Atomically rewrite checkpoint_dir's manifest of complete checkpoints.
+
+  Each entry records the checkpoint's prefix (relative to checkpoint_dir),
+  step, total size in bytes and a hash of its per-tensor checksums."""
+  entries = read_manifest(checkpoint_dir) or []
+  drop = set([os.path.basename(x) for x in remove])
+  if add is not None:
+    drop.add(add['prefix'])
+  entries = [x for x in entries if x['prefix'] not in drop]
+  if add is not None:
+    entries.append(add)
+  entries.sort(key=lambda x: x['step'])
+  fname = os.path.join(checkpoint_dir, MANIFEST)
+  with open(fname + '.tmp', 'w') as f:
+    json.dump({'checkpoints': entries}, f, indent=1)
+  os.replace(fname + '.tmp', fname)
+
+def manifest_entry(prefix, step, checksums):
+  digest = zlib.crc32(json.dumps(sorted(checksums.items())).encode('utf-8'))
+  return {'prefix': os.path.basename(prefix), 'step': step, 'size': checkpoint_size(prefix), 'hash': '%08x' % digest, 'time': time.time()}
+
+def checkpoint_time(prefix):
+  files = checkpoint_files(prefix)
+  return max([os.path.getmtime(x) for x in files]) if files else time.time()
+
+def remove_checkpoint(prefix, archive_dir=None):
+  """Delete the files of a checkpoint, or move them into archive_dir."""
+  for path in checkpoint_files(prefix):
+    try:
+      if archive_dir is None:
+        os.remove(path)
+      else:
+        maketree(archive_dir)
+        shutil.move(path, os.path.join(archive_dir, os.path.basename(path)))
+    except OSError as e:
+      print('Failed to remove %s: %s' % (path, e))
+
+STATE_GROUP = '__state__'
+STATE_PREFIX = STATE_GROUP + '/'
+
+def resolve_checkpoint(save_path):
+  """Return (format, path) for a checkpoint path as accepted by Saver.restore."""
+  if save_path.endswith('.shards.json'):
+    return 'sharded', save_path
+  elif os.path.exists(save_path + '.shards.json'):
+    return 'sharded', save_path + '.shards.json'
+  elif '.ckpt' in os.path.basename(save_path):
+    return 'ckpt', save_path
+  elif save_path.endswith('.hdf5'):
+    return 'hdf5', save_path
+  elif save_path.endswith('.tensors'):
+    return 'tensors', save_path
+  elif os.path.exists(save_path + '.tensors'):
+    return 'tensors', save_path + '.tensors'
+  elif os.path.exists(save_path + '.npy') or os.path.exists(save_path + '-0.npy'):
+    return 'npy', save_path
+  elif os.path.exists(save_path + '.hdf5'):
+    return 'hdf5', save_path + '.hdf5'
+  raise Exception("Can't load checkpoint %s" % save_path)
+
+def hdf5_names(path):
+  names = []
+  with h5py.File(path, "r") as f:
+    f.visititems(lambda name, obj: names.append(name) if isinstance(obj, h5py.Dataset) else None)
+  return names
+
+def checkpoint_names(save_path):
+  """Return the set of tensor names stored in a checkpoint, or None if unknown."""
+  kind, path = resolve_checkpoint(save_path)
+  if kind == 'sharded':
+    with open(path) as f:
+      return set(json.load(f)['variables'])
+  elif kind == 'ckpt':
+    reader = pywrap_tensorflow.NewCheckpointReader(path)
+    return set([name + ':0' for name in reader.get_variable_to_shape_map()])
+  elif kind == 'hdf5':
+    return set(hdf5_names(path))
+  elif kind == 'tensors':
+    return set(read_tensor_index(path))
+
+def load_state(save_path):
+  """Return the extra state saved alongside a checkpoint by Saver.save(state=...)."""
+  kind, path = resolve_checkpoint(save_path)
+  if kind == 'sharded':
+    with open(path) as f:
+      manifest = json.load(f)
+    paths = [os.path.join(os.path.dirname(path), shard) for shard in manifest['shards']]
+  elif kind == 'hdf5':
+    paths = [path]
+  elif kind == 'tensors':
+    index = read_tensor_index(path)
+    return dict([(name[len(STATE_PREFIX):], np.array(tensor_value(path, entry))) for name, entry in index.items() if name.startswith(STATE_PREFIX)])
+  else:
+    return {}
+  state = {}
+  for path in paths:
+    with h5py.File(path, "r") as f:
+      if STATE_GROUP in f:
+        for key, dset in f[STATE_GROUP].items():
+          state[key] = dset[()]
+  return state
+
+class CheckpointReader(object):
+  """Reads tensors one at a time from any checkpoint format Saver.restore accepts.
+
+  Tensors are named like variables, with a ':0' suffix. No model graph or
+  session is needed."""
+
+  def __init__(self, save_path, include_state=False):
+    self.kind, self.path = resolve_checkpoint(save_path)
+    self.include_state = include_state
+    self.files = {}
+    self.loaded = (None, {})
+    if self.kind == 'sharded':
+      with open(self.path) as f:
+        manifest = json.load(f)
+      dirname = os.path.dirname(self.path)
+      self.shards = [os.path.join(dirname, shard) for shard in manifest['shards']]
+      self.index = dict([(name, self.shards[i]) for name, i in manifest['variables'].items()])
+    elif self.kind == 'hdf5':
+      self.index = dict([(name, self.path) for name in hdf5_names(self.path)])
+    elif self.kind == 'ckpt':
+      self.reader = pywrap_tensorflow.NewCheckpointReader(self.path)
+      self.index = dict([(name + ':0', self.path) for name in self.reader.get_variable_to_shape_map()])
+    elif self.kind == 'tensors':
+      self.tensors = read_tensor_index(self.path)
+      self.index = dict([(name, self.path) for name in self.tensors])
+    else:
+      # Pickled (name, value) pairs; the files have to be read to index them.
+      self.index = {}
+      self.shapes = {}
+      for out in sorted(glob(self.path + '-*.npy')):
+        for name, value in np.load(out, allow_pickle=True):
+          name = name if ':' in name else name + ':0'
+          self.index[name] = out
+          self.shapes[name] = list(np.shape(value))
+
+  def names(self):
+    return sorted([name for name in self.index if self.include_state or not name.startswith(STATE_PREFIX)])
+
+  def h5(self, path):
+    if path not in self.files:
+      self.files[path] = h5py.File(path, "r")
+    return self.files[path]
+
+  def shape(self, name):
+    if self.kind in ['sharded', 'hdf5']:
+      return list(self.h5(self.index[name])[name].shape)
+    elif self.kind == 'ckpt':
+      return self.reader.get_variable_to_shape_map()[name.split(':')[0]]
+    elif self.kind == 'tensors':
+      return list(self.tensors[name]['shape'])
+    return self.shapes[name]
+
+  def get(self, name):
+    if self.kind in ['sharded', 'hdf5']:
+      path = self.index[name]
+      return dataset_value(self.h5(path)[name], path)
+    elif self.kind == 'ckpt':
+      return self.reader.get_tensor(name.split(':')[0])
+    elif self.kind == 'tensors':
+      return tensor_value(self.path, self.tensors[name])
+    return self.npy_values(self.index[name])[name]
+
+  def npy_values(self, path):
+    """Return {name: value} for a pickled -N.npy file, keeping only the last file loaded."""
+    if self.loaded[0] != path:
+      self.loaded = (None, {})
+      self.loaded = (path, dict([(name if ':' in name else name + ':0', value) for name, value in np.load(path, allow_pickle=True)]))
+    return self.loaded[1]
+
+  def items(self, names=None):
+    """Yield (name, value) for `names` (default: names()).
+
+    Pickled -N.npy files can only be read whole, so their tensors are yielded
+    file by file, each file loaded once; other formats yield in order."""
+    names = self.names() if names is None else list(names)
+    if self.kind != 'npy':
+      for name in names:
+        yield name, self.get(name)
+      return
+    wanted = set(names)
+    for path in sorted(set([self.index[name] for name in names])):
+      for name, value in self.npy_values(path).items():
+        if name in wanted:
+          yield name, value
+    self.loaded = (None, {})
+
+  def close(self):
+    for f in self.files.values():
+      f.close()
+    self.files = {}
+
+def write_snapshot(ckpt, items, n=200e6):
+  """Write (name, value) pairs as a TF checkpoint, without a model graph.
+
+  Values are saved in bundles of up to n parameters, which are then merged,
+  so memory use is bounded by the bundle size."""
+  from tensorflow.python.ops import gen_io_ops
+  maketree(os.path.dirname(ckpt))
+  prefixes = []
+  with tf.Graph().as_default(), tf.Session(graph=tf.get_default_graph()) as session:
+    def flush(group):
+      prefix = '%s_temp/part-%05d' % (ckpt, len(prefixes))
+      feeds = [tf.placeholder(tf.as_dtype(value.dtype), value.shape) for name, value in group]
+      names = [name.split(':')[0] for name, value in group]
+      session.run(gen_io_ops.save_v2(prefix, names, [''] * len(names), feeds), dict([(feed, value) for feed, (name, value) in zip(feeds, group)]))
+      prefixes.append(prefix)
+    group = []
+    count = 0
+    for name, value in items:
+      group.append((name, np.asarray(value)))
+      count += np.prod(np.shape(value))
+      if count >= n:
+        flush(group)
+        group = []
+        count = 0
+    if group:
+      flush(group)
+    session.run(gen_io_ops.merge_v2_checkpoints(prefixes, ckpt, delete_old_dirs=True))
+  print('Writing snapshot %s' % ckpt)
+  tf.train.update_checkpoint_state(os.path.dirname(ckpt) or '.', ckpt)
 
 class Saver(object):
   def __init__(
@@ -184,10 +691,19 @@ class Saver(object):
     write_version=tf.train.SaverDef.V2,
     pad_step_number=False,
     save_relative_paths=False,
-    filename=None):
+    filename=None,
+    async_save=False,
+    restore_threads=1,
+    save_dtype=None,
+    compression=None,
+    verify=False,
+    state_var_list=None,
+    state_dtype=None,
+    archive_dir=None):
     self.var_list = var_list
     self.reshape = reshape
     self.sharded = sharded
+    self.shards = (4 if sharded is True else int(sharded)) if sharded else 0
     self.max_to_keep = max_to_keep
     self.keep_checkpoint_every_n_hours = keep_checkpoint_every_n_hours
     self.name = name
@@ -200,19 +716,48 @@ class Saver(object):
     self.pad_step_number = pad_step_number
     self.save_relative_paths = save_relative_paths
     self.filename = filename
+    self.async_save = async_save
+    self.restore_threads = restore_threads
+    self.save_dtype = save_dtype
+    self.compression = compression
+    self.verify = verify
+    self.state_var_list = state_var_list
+    self.state_dtype = state_dtype
+    self.restored_var_list = []
+    self.state = {}
+    self.archive_dir = archive_dir
     self.checkpoints = []
+    self.recovered = set()
+    self.preserved_time = None
+    self.archiving = None
+    self.pending = None
+    self.pending_error = None
+    savers.add(self)
 
   def restore(self, sess, save_path):
-    if '.ckpt' in os.path.basename(save_path):
-      load_snapshot(save_path, session=sess, var_list=self.var_list, reshape=self.reshape)
-    elif save_path.endswith('.hdf5'):
-      load_variables(save_path, session=sess, var_list=self.var_list, reshape=self.reshape)
-    elif os.path.exists(save_path + '.npy') or os.path.exists(save_path + '-0.npy'):
-      load_weights(save_path, session=sess, var_list=self.var_list, reshape=self.reshape)
-    elif os.path.exists(save_path + '.hdf5'):
-      load_variables(save_path + '.hdf5', session=sess, var_list=self.var_list, reshape=self.reshape)
+    """Restore the variables, plus any state variables found in the checkpoint.
+
+    Returns the extra state passed to save(state=...), also kept as self.state."""
+    vs = list(self.var_list or tf.trainable_variables())
+    if self.state_var_list:
+      names = checkpoint_names(save_path) or set()
+      known = set([v.name for v in vs])
+      found = [v for v in self.state_var_list if v.name in names and v.name not in known]
+      if len(found) < len(self.state_var_list):
+        print('%d of %d training state variables not in checkpoint; leaving them initialized' % (len(self.state_var_list) - len(found), len(self.state_var_list)))
+      vs += found
+    kind, path = resolve_checkpoint(save_path)
+    if kind == 'sharded':
+      load_sharded(path, session=sess, var_list=vs, reshape=self.reshape, threads=self.restore_threads if self.restore_threads > 1 else None, verify=self.verify)
+    elif kind == 'ckpt':
+      load_snapshot(path, session=sess, var_list=vs, reshape=self.reshape)
+    elif kind in ['tensors', 'npy']:
+      load_weights(path, session=sess, var_list=vs, reshape=self.reshape, verify=self.verify)
     else:
-      raise Exception("Can't load checkpoint %s" % save_path)
+      load_variables(path, session=sess, var_list=vs, reshape=self.reshape, threads=self.restore_threads, verify=self.verify)
+    self.restored_var_list = vs
+    self.state = load_state(save_path)
+    return self.state
 
   def save(self,
         sess,
@@ -223,24 +768,130 @@ class Saver(object):
         write_meta_graph=True,
         write_state=True,
         strip_default_attrs=False,
-        save_debug_info=False):
+        save_debug_info=False,
+        state=None,
+        on_saved=None):
+    """Save the variables, the state variables and `state`, a dict of extra
+    numpy-compatible values (returned by restore).
+
+    `on_saved(prefix)` is called once the checkpoint is completely written and
+    listed in the manifest; with async_save, that is on the writer thread."""
     if global_step is not None:
-      name = '%s-%d.hdf5' % (save_path, global_step)
+      prefix = '%s-%d' % (save_path, global_step)
+    else:
+      prefix = save_path
+    self.recover_checkpoints(save_path)
+    vs = list(self.var_list or tf.trainable_variables())
+    known = set([v.name for v in vs])
+    state_vs = [v for v in (self.state_var_list or []) if v.name not in known]
+    state_names = set([v.name for v in state_vs])
+    vs += state_vs
+    groups = shard_variables(vs, self.shards) if self.shards else [vs]
+    def items(group, progress=True):
+      for variable, value in fetch_variables(sess, group, progress=progress):
+        if variable.name in state_names:
+          value = cast_value(value, self.state_dtype)
+        yield variable.name, value
+    extra = [(STATE_PREFIX + key, np.asarray(value)) for key, value in (state or {}).items()]
+    if self.async_save:
+      # Only one save may be in flight; wait for the previous one first.
+      self.wait()
+      # Snapshot to host memory now; training may change the variables
+      # while the write is in progress.
+      groups = [list(items(group)) for group in groups]
+      groups[0] += extra
+      self.pending = threading.Thread(target=self.write_async, args=(prefix, global_step, groups, on_saved))
+      self.pending.start()
     else:
-      name = '%s.hdf5' % save_path
-    save_variables(name, session=sess, var_list=self.var_list)
-    self.checkpoints.append(name)
-    if self.max_to_keep > 0:
-      while len(self.checkpoints) > self.max_to_keep:
-        fname = self.checkpoints[0]
-        if fname != name:
-          print('Truncating %s' % fname)
-          try:
-            with open(fname, "wb") as f:
-              pass
-          except:
-            print('Failed to truncate %s' % fname)
-        self.checkpoints = self.checkpoints[1:]
+      progress = len(groups) <= 1
+      groups = [items(group, progress=progress) for group in groups]
+      groups[0] = itertools.chain(groups[0], extra)
+      self.write(prefix, global_step, groups, on_saved)
+
+  def write(self, prefix, step, groups, on_saved=None):
+    if self.shards:
+      checksums = write_sharded(prefix, groups, dtype=self.save_dtype, compression=self.compression)
+    else:
+      checksums = write_variables(prefix + '.hdf5', groups[0], dtype=self.save_dtype, compression=self.compression)
+    update_manifest(os.path.dirname(prefix), add=manifest_entry(prefix, -1 if step is None else step, checksums))
+    self.rotate(prefix)
+    if on_saved is not None:
+      on_saved(prefix)
+
+  def write_async(self, prefix, step, groups, on_saved=None):
+    try:
+      self.write(prefix, step, groups, on_saved)
+    except Exception as e:
+      self.pending_error = e
+
+  def wait(self):
+    """Block until any in-flight async save has been written."""
+    if self.pending is not None:
+      self.pending.join()
+      self.pending = None
+    if self.archiving is not None:
+      self.archiving.join()
+      self.archiving = None
+    if self.pending_error is not None:
+      e = self.pending_error
+      self.pending_error = None
+      raise e
+
+  def recover_checkpoints(self, save_path):
+    """Track the checkpoints already saved under `save_path` (e.g. by an
+    earlier run), so that rotation covers them too. Only scans once."""
+    if save_path in self.recovered:
+      return
+    self.recovered.add(save_path)
+    known = set([prefix for prefix, t in self.checkpoints])
+    found = [(prefix, checkpoint_time(prefix)) for step, prefix in list_checkpoints(save_path) if prefix not in known]
+    self.checkpoints = found + self.checkpoints
+    if found and self.preserved_time is None:
+      self.preserved_time = found[0][1]
+
+  def rotate(self, prefix):
+    """Delete (or archive) the oldest checkpoints beyond max_to_keep.
+
+    As with tf.train.Saver, one checkpoint per keep_checkpoint_every_n_hours
+    is preserved instead of deleted."""
+    now = time.time()
+    self.checkpoints.append((prefix, now))
+    if self.preserved_time is None:
+      self.preserved_time = now
+    if self.max_to_keep <= 0 or len(self.checkpoints) <= self.max_to_keep:
+      return
+    expired = self.checkpoints[:-self.max_to_keep]
+    self.checkpoints = self.checkpoints[-self.max_to_keep:]
+    removed = []
+    for old, t in expired:
+      if t - self.preserved_time >= self.keep_checkpoint_every_n_hours * 3600:
+        print('Preserving %s' % old)
+        self.preserved_time = t
+      else:
+        removed.append(old)
+    if removed:
+      update_manifest(os.path.dirname(prefix), remove=removed)
+    if self.archive_dir is None:
+      for old in removed:
+        print('Removing %s' % old)
+        remove_checkpoint(old)
+    else:
+      # Moving to slower storage can take a while; don't block on it.
+      if self.archiving is not None:
+        self.archiving.join()
+      def archive():
+        for old in removed:
+          print('Archiving %s to %s' % (old, self.archive_dir))
+          remove_checkpoint(old, archive_dir=self.archive_dir)
+      self.archiving = threading.Thread(target=archive)
+      self.archiving.start()
+
+savers = weakref.WeakSet()
+
+def flush_saves():
+  """Wait for every Saver's in-flight async save to finish."""
+  for saver in list(savers):
+    saver.wait()
 
 class Commands(object):
   def __init__(self, path='commands'):
@@ -476,5 +1127,6 @@ def save_and_quit():
   if has_command('save'):
     print("Saving...")
     run_command('save')
+  flush_saves()
   quit()
 
@@ -0,0 +1,180 @@
+import socket
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import tflex
+
+class Ring(object):
+  """A ring of `world_size` processes connected over TCP, for data-parallel training.
+
+  Rank r listens on port + r, connects to rank r + 1 and accepts a
+  connection from rank r - 1, so each rank only ever sends to its successor
+  and receives from its predecessor. allreduce() is the bandwidth-optimal
+  ring algorithm (a reduce-scatter then an allgather, each of world_size - 1
+  steps moving 1/world_size of the buffer), run on the host in numpy.
+
+  Once connected, a rank that waits more than `timeout` seconds for its
+  neighbours, or whose neighbour closed its connection, raises
+  ConnectionError, so the other ranks stop when one of them does."""
+
+  def __init__(self, rank, world_size, host='127.0.0.1', port=29500, timeout=600.0):
+    self.rank = rank
+    self.world_size = world_size
+    self.next = None
+    self.prev = None
+    if world_size <= 1:
+      return
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port + rank))
+    listener.listen(1)
+    listener.settimeout(timeout)
+    accepted = []
+    def accept():
+      try:
+        accepted.append(listener.accept()[0])
+      except socket.timeout:
+        pass
+    accepter = threading.Thread(target=accept)
+    accepter.start()
+    deadline = time.time() + timeout
+    target = (host, port + (rank + 1) % world_size)
+    try:
+      while True:
+        try:
+          self.next = socket.create_connection(target)
+          break
+        except OSError:
+          if time.time() > deadline:
+            raise ConnectionError('Rank %d could not connect to rank %d at %s:%d' % (rank, (rank + 1) % world_size, target[0], target[1]))
+          time.sleep(0.1)
+    finally:
+      accepter.join()
+      listener.close()
+    if not accepted:
+      self.next.close()
+      raise ConnectionError('Rank %d timed out waiting for rank %d to connect' % (rank, (rank - 1) % world_size))
+    self.prev = accepted[0]
+    for sock in [self.next, self.prev]:
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      sock.settimeout(timeout)
+
+  def recv_into(self, view):
+    """Fill `view` from the previous rank."""
+    prev = (self.rank - 1) % self.world_size
+    while len(view) > 0:
+      try:
+        n = self.prev.recv_into(view)
+      except socket.timeout:
+        raise ConnectionError('Rank %d timed out waiting for rank %d' % (self.rank, prev))
+      if n == 0:
+        raise ConnectionError('Rank %d lost its connection to rank %d' % (self.rank, prev))
+      view = view[n:]
+
+  def sendall(self, data):
+    try:
+      self.next.sendall(data)
+    except socket.timeout:
+      raise ConnectionError('Rank %d timed out sending to rank %d' % (self.rank, (self.rank + 1) % self.world_size))
+
+  def send_recv(self, send, recv):
+    """Send `send` to the next rank while receiving into `recv` from the previous one."""
+    errors = []
+    def send_all():
+      try:
+        self.sendall(memoryview(send).cast('B'))
+      except OSError as e:
+        errors.append(e)
+    sender = threading.Thread(target=send_all)
+    sender.start()
+    self.recv_into(memoryview(recv).cast('B'))
+    sender.join()
+    if errors:
+      raise ConnectionError(str(errors[0]))
+
+  def allreduce(self, buf):
+    """Sum a contiguous 1-D numpy array across all ranks, in place."""
+    n = self.world_size
+    if n <= 1:
+      return buf
+    bounds = [len(buf) * i // n for i in range(n + 1)]
+    chunk = lambda i: buf[bounds[i % n]:bounds[i % n + 1]]
+    scratch = np.empty(bounds[1] - bounds[0] + 1, dtype=buf.dtype)
+    for step in range(n - 1):
+      incoming = chunk(self.rank - step - 1)
+      tmp = scratch[:len(incoming)]
+      self.send_recv(chunk(self.rank - step), tmp)
+      incoming += tmp
+    for step in range(n - 1):
+      self.send_recv(chunk(self.rank - step + 1), chunk(self.rank - step))
+    return buf
+
+  def broadcast(self, buf, root=0):
+    """Copy a contiguous numpy array from `root` to all ranks, in place."""
+    if self.world_size <= 1:
+      return buf
+    data = buf.reshape([-1]).view(np.uint8)
+    if self.rank != root:
+      self.recv_into(memoryview(data))
+    if (self.rank + 1) % self.world_size != root:
+      self.sendall(memoryview(data))
+    return buf
+
+  def close(self):
+    for sock in [self.next, self.prev]:
+      if sock is not None:
+        sock.close()
+    self.next = self.prev = None
+
+def broadcast_variables(ring, session, variables, root=0):
+  """Overwrite `variables` on every rank with their values on `root`."""
+  for group in tflex.split_by_params(variables):
+    if len(group) == 0:
+      continue
+    # np.ascontiguousarray would turn scalars (e.g. global_step) into shape [1].
+    values = [np.array(value, order='C') for value in session.run(group)]
+    for value in values:
+      ring.broadcast(value, root=root)
+    tflex.assign_values(group, values, session=session)
+
+def flatten_gradients(grads_and_vars):
+  """Concatenate the gradients into one float32 vector, with zeros for missing gradients."""
+  return tf.concat([tf.reshape(tf.cast(g if g is not None else tf.zeros_like(v), tf.float32), [-1])
+                    for g, v in grads_and_vars], axis=0)
+
+def apply_flat_gradients(opt, variables, global_step=None):
+  """Return (placeholder, op) applying a flat gradient vector, laid out as by
+  flatten_gradients, to `variables` with `opt`."""
+  sizes = [int(np.prod(v.shape.as_list())) for v in variables]
+  flat = tf.placeholder(tf.float32, [sum(sizes)], name='flat_gradients')
+  grads = [tf.cast(tf.reshape(g, v.shape), v.dtype.base_dtype) for g, v in zip(tf.split(flat, sizes), variables)]
+  return flat, opt.apply_gradients(list(zip(grads, variables)), global_step=global_step)
+
+def check_broadcast(rank, world_size=2, port=29500):
+  """Broadcast a scalar and a matrix variable from rank 0 and check the result."""
+  ring = Ring(rank, world_size, port=port, timeout=60.0)
+  with tf.Graph().as_default(), tf.Session() as session:
+    step = tf.Variable(0, dtype=tf.int64, name='step')
+    weights = tf.Variable(tf.zeros([3, 4]), name='weights')
+    session.run(tf.global_variables_initializer())
+    if rank == 0:
+      tflex.assign_values([step, weights], [np.array(42, dtype=np.int64), np.arange(12, dtype=np.float32).reshape([3, 4])], session=session)
+    broadcast_variables(ring, session, [step, weights])
+    step_value, weights_value = session.run([step, weights])
+    assert step_value == 42, step_value
+    assert (weights_value == np.arange(12).reshape([3, 4])).all(), weights_value
+  ring.close()
+
+if __name__ == '__main__':
+  # Self-check: python3 tflex_dist.py
+  import multiprocessing
+  ranks = [multiprocessing.Process(target=check_broadcast, args=(rank,)) for rank in range(2)]
+  for process in ranks:
+    process.start()
+  for process in ranks:
+    process.join()
+  assert all([process.exitcode == 0 for process in ranks]), 'broadcast_variables check failed'
+  print('ok')
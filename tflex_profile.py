@@ -0,0 +1,85 @@
+import json
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+class StepTimer(object):
+  """Times the phases of each training step.
+
+  Wrap each part of a step in `with timer.phase(name):`, then call end() to
+  write the step's record as one JSON line to `path` and add it to the
+  rolling window that percentiles() reports over. Time not spent in any
+  phase is recorded as 'other'."""
+
+  def __init__(self, path=None, window=100, every=1):
+    self.path = path
+    self.every = every
+    self.history = {}
+    self.window = window
+    self.file = None
+    if path is not None:
+      os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+      self.file = open(path, 'a')
+    self.step = None
+    self.phases = {}
+    self.start_time = None
+
+  def start(self, step):
+    self.step = step
+    self.phases = {}
+    self.start_time = time.time()
+
+  @contextmanager
+  def phase(self, name):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.phases[name] = self.phases.get(name, 0.0) + time.time() - start
+
+  def end(self, **extra):
+    total = time.time() - self.start_time
+    phases = dict(self.phases)
+    phases['other'] = max(0.0, total - sum(phases.values()))
+    phases['total'] = total
+    for name, elapsed in phases.items():
+      if name not in self.history:
+        self.history[name] = deque(maxlen=self.window)
+      self.history[name].append(elapsed)
+    if self.file is not None and self.every > 0 and self.step % self.every == 0:
+      record = dict(step=self.step, time=self.start_time, **phases)
+      record.update(extra)
+      self.file.write(json.dumps(record) + '\n')
+      # Runs are often killed rather than stopped; keep the file current.
+      self.file.flush()
+    return phases
+
+  def percentiles(self, q=(50, 90, 99)):
+    """Return {phase: {'p50': secs, ...}} over the last `window` steps."""
+    return dict([(name, dict([('p%d' % p, float(np.percentile(values, p))) for p in q]))
+                 for name, values in self.history.items() if len(values) > 0])
+
+  def report(self, q=(50, 90, 99)):
+    stats = self.percentiles(q)
+    names = ['total'] + sorted([name for name in stats if name != 'total'])
+    return ' '.join(['%s=%s' % (name, '/'.join(['%.4f' % stats[name]['p%d' % p] for p in q])) for name in names if name in stats])
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+def trace_options():
+  """Return (options, run_metadata) to pass to session.run to trace one step."""
+  return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+def write_timeline(run_metadata, path):
+  """Write a traced step as a Chrome trace (open it in chrome://tracing)."""
+  trace = timeline.Timeline(run_metadata.step_stats)
+  with open(path, 'w') as f:
+    f.write(trace.generate_chrome_trace_format())
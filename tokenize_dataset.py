@@ -2,6 +2,10 @@
 import argparse
 import numpy as np
 
+import os
+import sys
+sys.path += [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')]
+
 from tokenizers import Tokenizer, models, pre_tokenizers, decoders
 
 parser = argparse.ArgumentParser(
@@ -13,7 +17,7 @@ parser.add_argument('-s', '--step', type=int, default=128*1024, help='Number of
 parser.add_argument('-b', '--batch', action='store_true', default=False, help='Use tokenizer.encode_batch')
 parser.add_argument('-c', '--compression', action='store_true', default=False, help='Save using compression (via .savez_compressed)')
 parser.add_argument('in_text', metavar='PATH', type=str, help='Input file')
-parser.add_argument('out_npz', metavar='OUT.npz', type=str, default='', nargs='?', help='Output file path')
+parser.add_argument('out_npz', metavar='OUT.npz', type=str, default='', nargs='?', help='Output file path (.npz, or .tok for a memory-mappable token file)')
 args = parser.parse_args()
 
 # Initialize a tokenizer based on BPE
@@ -62,6 +66,7 @@ def group(n, iterable, fillvalue=None):
     return itertools.zip_longest(*args, fillvalue=fillvalue)
 
 import tflex_utils
+from load_dataset import save_tokens
 import tqdm
 import time
 start = time.time()
@@ -89,7 +94,9 @@ elapsed = time.time() - start
 print('%d tokens in %.4fs (%.4f tokens/sec)' % (len(tokens), elapsed, len(tokens)/elapsed))
 if args.out_npz and len(args.out_npz) > 0:
   print('Saving to %s...' % args.out_npz)
-  if args.compression:
+  if args.out_npz.endswith('.tok'):
+    save_tokens(args.out_npz, [tokens])
+  elif args.compression:
     np.savez_compressed(args.out_npz, tokens)
   else:
     np.savez(args.out_npz, tokens)
@@ -13,13 +13,13 @@ import time
 import horovod.tensorflow as hvd
 
 import model, sample, encoder
-from load_dataset import load_dataset, Sampler
+from accumulate import AccumulatingOptimizer
+from load_dataset import load_dataset, Sampler, MemmapSampler
+from tflex_profile import StepTimer
 
 CHECKPOINT_DIR = 'checkpoint'
 SAMPLE_DIR = 'samples'
 
-hvd.init()
-
 def maketree(path):
     try:
         os.makedirs(path)
@@ -27,6 +27,14 @@ def maketree(path):
         pass
 
 
+def layer_gradient_bytes(hparams, fp16_allreduce):
+    """Size of the gradients of one transformer block as sent by the all-reduce."""
+    # attn c_attn + c_proj, mlp c_fc + c_proj, ln_1 + ln_2
+    n = hparams.n_embd
+    params = (3 * n * n + 3 * n) + (n * n + n) + (4 * n * n + 4 * n) + (4 * n * n + n) + 4 * n
+    return params * (2 if fp16_allreduce else 4)
+
+
 def train_main(dataset,
                model_name='117M',
                seed=None,
@@ -37,13 +45,44 @@ def train_main(dataset,
                run_name='run1',
                restore_from='latest',
                save_every=2000,
-               combine=50000):
+               combine=50000,
+               fp16_allreduce=False,
+               fusion_threshold_mb=None,
+               cycle_time_ms=None,
+               accumulate=1,
+               log_every=10):
+    """Train with Horovod, one process per GPU.
+
+    fp16_allreduce: Compress gradients to float16 for the all-reduce.
+    fusion_threshold_mb: Horovod tensor fusion buffer size. Defaults to the
+        gradients of one transformer block, so each layer's gradients are sent
+        as soon as backprop produces them instead of waiting for the next ones.
+    cycle_time_ms: Horovod cycle time between fusion rounds.
+    accumulate: Accumulate gradients locally over this many micro-batches
+        before each all-reduce and update.
+    log_every: Write this rank's throughput to checkpoint/<run_name>/throughput-rank-N.jsonl
+        every N steps. Disabled if set <= 0.
+    """
 
     enc = encoder.get_encoder(model_name)
     hparams = model.default_hparams()
     with open(os.path.join('models', model_name, 'hparams.json')) as f:
         hparams.override_from_dict(json.load(f))
 
+    # Horovod reads its tuning from the environment in hvd.init(); explicit
+    # environment settings win.
+    if fusion_threshold_mb is None:
+        fusion_threshold = layer_gradient_bytes(hparams, fp16_allreduce)
+    else:
+        fusion_threshold = int(fusion_threshold_mb * 1024 * 1024)
+    os.environ.setdefault('HOROVOD_FUSION_THRESHOLD', str(fusion_threshold))
+    if cycle_time_ms is not None:
+        os.environ.setdefault('HOROVOD_CYCLE_TIME', str(cycle_time_ms))
+    hvd.init()
+    if hvd.rank() == 0:
+        print('Horovod: size={} fusion_threshold={} fp16_allreduce={} accumulate={}'.format(
+            hvd.size(), os.environ['HOROVOD_FUSION_THRESHOLD'], fp16_allreduce, accumulate))
+
     if sample_length is None:
         sample_length = hparams.n_ctx // 2
     elif sample_length > hparams.n_ctx:
@@ -75,9 +114,22 @@ def train_main(dataset,
 
         train_vars = [v for v in tf.trainable_variables() if 'model' in v.name]
 
-        opt = tf.train.AdamOptimizer()
-        opt = hvd.DistributedOptimizer(opt)
-        train_op = opt.minimize(loss, var_list=train_vars)
+        compression = hvd.Compression.fp16 if fp16_allreduce else hvd.Compression.none
+        if accumulate > 1:
+            # Sum the gradients of `accumulate` micro-batches locally, then
+            # all-reduce the sums once per update.
+            opt = AccumulatingOptimizer(
+                opt=tf.train.AdamOptimizer(), var_list=train_vars)
+            opt_reset = opt.reset()
+            opt_compute = opt.compute_gradients(loss)
+            grads = [(hvd.allreduce(opt.accum_vars[v], compression=compression), v)
+                     for v in train_vars]
+            with tf.control_dependencies([opt.opt.apply_gradients(grads)]):
+                opt_apply = opt.total_loss / opt.count_loss
+        else:
+            opt = tf.train.AdamOptimizer()
+            opt = hvd.DistributedOptimizer(opt, compression=compression)
+            train_op = opt.minimize(loss, var_list=train_vars)
 
         # Horovod: broadcast initial variable states from rank 0 to all other processes.
         # This is necessary to ensure consistent initialization of all workers when
@@ -109,9 +161,15 @@ def train_main(dataset,
 
         bcast.run()
 
+        # Each rank samples from its own share of the dataset with its own seed.
+        # A .tok file is memory-mapped, so ranks on one node share its pages.
         print(str(hvd.local_rank()), 'Loading dataset...')
-        chunks = load_dataset(enc, dataset, combine)
-        data_sampler = Sampler(chunks)
+        sampler_seed = None if seed is None else seed + hvd.rank()
+        if dataset.endswith('.tok'):
+            data_sampler = MemmapSampler(dataset, seed=sampler_seed).shard(hvd.rank(), hvd.size())
+        else:
+            chunks = load_dataset(enc, dataset, combine, shard_index=hvd.rank(), shard_count=hvd.size())
+            data_sampler = Sampler(chunks, seed=sampler_seed)
         print(str(hvd.local_rank()), 'dataset has', data_sampler.total_size, 'tokens')
         print(str(hvd.local_rank()), 'Training...')
 
@@ -158,13 +216,37 @@ def train_main(dataset,
 
         avg_loss = (0.0, 0.0)
         start_time = time.time()
+        tokens_per_step = batch_size * 1024 * max(1, accumulate)
+        timer = StepTimer(
+            os.path.join(CHECKPOINT_DIR, run_name, 'throughput-rank-{}.jsonl'.format(hvd.rank()))
+            if log_every > 0 else None,
+            every=log_every)
+
+        def train_step():
+            if accumulate > 1:
+                sess.run(opt_reset)
+                for _ in range(accumulate):
+                    with timer.phase('feed'):
+                        batch = data_sampler.sample_batch(batch_size, 1024)
+                    with timer.phase('compute'):
+                        sess.run(opt_compute, feed_dict={context: batch})
+                with timer.phase('allreduce_apply'):
+                    return sess.run(opt_apply)
+            with timer.phase('feed'):
+                batch = data_sampler.sample_batch(batch_size, 1024)
+            with timer.phase('run'):
+                _, lv = sess.run((train_op, loss), feed_dict={context: batch})
+            return lv
 
         try:
             while True:
 
-                batch = [data_sampler.sample(1024) for _ in range(batch_size)]
-
-                _, lv = sess.run((train_op, loss), feed_dict={context: batch})
+                timer.start(counter)
+                lv = train_step()
+                phases = timer.end(rank=hvd.rank(), tokens=tokens_per_step, loss=float(lv))
+                if log_every > 0 and counter % log_every == 0:
+                    print('rank {} [{}] {:2.2f} tokens/s ({})'.format(
+                        hvd.rank(), counter, tokens_per_step / phases['total'], timer.report()))
 
                 avg_loss = (avg_loss[0] * 0.99 + lv, avg_loss[1] * 0.99 + 1.0)
 
@@ -188,6 +270,8 @@ def train_main(dataset,
             print('interrupted')
             if hvd.rank() == 0:
                 save()
+        finally:
+            timer.close()
 
 
 if __name__ == '__main__':
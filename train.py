@@ -7,6 +7,8 @@ sys.path += [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')]
 
 import argparse
 import json
+import hashlib
+import threading
 import numpy as np
 import tensorflow as tf
 import time
@@ -15,13 +17,15 @@ from tensorflow.core.protobuf import rewriter_config_pb2
 from tensorflow.python import pywrap_tensorflow
 
 import model, sample, encoder
-from load_dataset import load_dataset, Sampler, TextSampler
+from load_dataset import load_dataset, dataset_paths, load_tokens, shard_chunks, Sampler, MemmapSampler, PackedSampler, TextSampler, Prefetcher
 from accumulate import AccumulatingOptimizer
 import memory_saving_gradients
 from glob import glob
 import re
 import tflex
 import tflex_sgdr
+import tflex_profile
+import tflex_dist
 
 import pytz
 from datetime import datetime, timezone
@@ -34,9 +38,10 @@ parser = argparse.ArgumentParser(
     description='Fine-tune GPT-2 on your custom dataset.',
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-parser.add_argument('--dataset', metavar='PATH', type=str, required=True, help='Input file, directory, or glob pattern (utf-8 text, or preencoded .npz files).')
+parser.add_argument('--dataset', metavar='PATH', type=str, required=True, help='Input file, directory, or glob pattern (utf-8 text, or preencoded .npz files), or a preencoded .tok file.')
 parser.add_argument('--model_name', metavar='MODEL', type=str, default='117M', help='Pretrained model name')
 parser.add_argument('--combine', metavar='CHARS', type=int, default=50000, help='Concatenate input files with <|endoftext|> separator into chunks of this minimum size')
+parser.add_argument('--pack', default=False, action='store_true', help='Train on rows of whole documents (split at <|endoftext|> and at chunk boundaries) packed end to end, with attention masked to each document and positions restarting at each one.')
 
 parser.add_argument('--batch_size', metavar='SIZE', type=int, default=1, help='Batch size')
 parser.add_argument('--learning_rate', metavar='LR', type=float, default=0.00002, help='Learning rate for Adam')
@@ -62,14 +67,33 @@ parser.add_argument('--sample_num', metavar='N', type=int, default=1, help='Gene
 parser.add_argument('--save_every', metavar='N', type=int, default=-1, help='Write a checkpoint every N steps')
 parser.add_argument('--save_time', metavar='N', type=float, default=15.0, help='Write a checkpoint every N minutes')
 parser.add_argument('--max_to_keep', metavar='N', type=int, default=5, help='Only keep the last N checkpoints')
+parser.add_argument('--keep_checkpoint_every_n_hours', metavar='HOURS', type=float, default=10000.0, help='Keep one checkpoint every N hours instead of rotating it out')
+parser.add_argument('--archive_dir', metavar='PATH', type=str, default=None, help='Move rotated-out checkpoints here (in the background) instead of deleting them')
+parser.add_argument('--save_async', default=False, action='store_true', help='Write checkpoints to disk on a background thread while training continues')
+parser.add_argument('--save_dtype', type=str, default=None, help='Store checkpoint weights as this dtype (e.g. float16 for inference exports). Defaults to each variable\'s own dtype.')
+parser.add_argument('--save_compression', type=str, default=None, help='Compress checkpoint datasets with this hdf5 filter <gzip|lzf>. Compressed checkpoints restore more slowly.')
+parser.add_argument('--save_shards', metavar='N', type=int, default=0, help='Split checkpoints into N hdf5 files written and read concurrently. Disabled if set <= 0')
+parser.add_argument('--save_training_state', default=False, action='store_true', help='Also checkpoint optimizer slots, global_step and the dataset sampler state, so training resumes exactly where it stopped')
+parser.add_argument('--training_state_dtype', type=str, default=None, help='Store optimizer slots as this dtype (e.g. float16) when using --save_training_state')
+parser.add_argument('--restore_threads', metavar='N', type=int, default=1, help='Load N groups of variables concurrently when restoring an hdf5 checkpoint')
 
 parser.add_argument('--val_dataset', metavar='PATH', type=str, default=None, help='Dataset for validation loss, defaults to --dataset.')
 parser.add_argument('--val_batch_size', metavar='SIZE', type=int, default=1, help='Batch size for validation.')
 parser.add_argument('--val_batch_count', metavar='N', type=int, default=80, help='Number of batches for validation.')
 parser.add_argument('--val_every', metavar='STEPS', type=int, default=0, help='Calculate validation loss every STEPS steps.')
+parser.add_argument('--val_eval_batch_size', metavar='SIZE', type=int, default=-1, help='Number of validation sequences to evaluate per session call. Equal to val_batch_size if set <= 0. The validation set is still val_batch_size * val_batch_count sequences.')
+parser.add_argument('--val_cache_dir', metavar='PATH', type=str, default=None, help='Cache the sampled validation set in PATH, keyed by dataset, seed, n_ctx and size, so later runs skip sampling it.')
+parser.add_argument('--val_async', default=False, action='store_true', help='Calculate validation loss on a background thread while training continues (against weights that may change during the pass).')
+parser.add_argument('--val_device', metavar='DEVICE', type=str, default=None, help='Place the validation graph on this device, e.g. /cpu:0 or /gpu:1.')
 
 parser.add_argument('--init_tpu', default=False, action='store_true', help='Initialize TPU session.')
 
+parser.add_argument('--dist_world_size', metavar='N', type=int, default=1, help='Train data-parallel across N processes, averaging gradients with a ring all-reduce over TCP. Start one process per rank with the same arguments and a different --dist_rank.')
+parser.add_argument('--dist_rank', metavar='RANK', type=int, default=0, help='This process\'s rank, 0 to dist_world_size-1. Only rank 0 saves checkpoints, generates samples, validates and runs commands.')
+parser.add_argument('--dist_host', type=str, default='127.0.0.1', help='Address the ranks listen on.')
+parser.add_argument('--dist_port', type=int, default=29500, help='Rank r listens on dist_port + r.')
+parser.add_argument('--dist_timeout', metavar='SECS', type=float, default=1800.0, help='Stop if another rank is unreachable or silent for this long (it must cover rank 0\'s saves, samples and validation).')
+
 parser.add_argument('--fresh_model', default=False, action='store_true', help="Don't load model from disk; initialize model weights to random values")
 parser.add_argument('--save_on_ctrlc', default=False, action='store_true', help='When execution is interrupted, should we save the model to disk?')
 parser.add_argument('--debug_on_ctrlc', default=False, action='store_true', help='When execution is interrupted, attach a debugger (pdb.set_trace())')
@@ -114,8 +138,15 @@ parser.add_argument('--debug_before_training', default=False, action='store_true
 parser.add_argument('--dropout', type=float, default=0.0, help="Dropout value. Disabled if set <= 0.0. For training on large datasets, 0.1 tends to be a good value.")
 
 parser.add_argument('--seed', type=int, default=-1, help='Deterministic seed for dataset sampler. Disabled if set < 0')
+parser.add_argument('--prefetch', metavar='N', type=int, default=4, help='Sample up to N training batches ahead on a background thread. Disabled if set <= 0')
 
 parser.add_argument('--save_graph', default=False, action='store_true', help="Save TensorFlow graph to summary log (to see ops in tensorboard)")
+parser.add_argument('--summary_every', metavar='N', type=int, default=10, help='Write TensorBoard summaries (loss, learning rate, gradient norm, tokens/s, step time) every N steps. Disabled if set <= 0')
+parser.add_argument('--timing_every', metavar='N', type=int, default=1, help='Append a JSON line with the time spent in each phase of the step (sample, feed, run, summaries, commands, checkpoint, eval) to <checkpoint>/<run>/timing.jsonl every N steps. Disabled if set <= 0')
+parser.add_argument('--timing_window', metavar='N', type=int, default=100, help='Number of recent steps the step time percentiles are computed over')
+parser.add_argument('--timing_report', metavar='N', type=int, default=100, help='Print p50/p90/p99 step phase times every N steps. Disabled if set <= 0')
+parser.add_argument('--profile_step', metavar='N', type=int, default=-1, help='Trace step N with tf.RunMetadata and write a Chrome trace to <checkpoint>/<run>/timeline-N.json. Disabled if set < 0')
+parser.add_argument('--summary_flush_secs', metavar='SECONDS', type=int, default=30, help='Flush the TensorBoard summary log to disk every SECONDS, from a background thread')
 
 PST = pytz.timezone('US/Pacific')
 
@@ -133,6 +164,41 @@ def maketree(path):
         pass
 
 
+def scalar_summary(**values):
+    """Build a tf.Summary of scalars on the host, without a session call."""
+    return tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=float(value)) for tag, value in sorted(values.items())])
+
+
+def val_cache_path(cache_dir, dataset, seed, length, count):
+    """Return the cache file for a sampled validation set.
+
+    The key covers the path, size and modification time of each of the
+    dataset's files (it may be a directory or glob), so the cache is
+    resampled whenever the dataset changes."""
+    files = []
+    for path in sorted(dataset_paths(dataset)):
+        stat = os.stat(path)
+        files.append([os.path.abspath(path), stat.st_size, stat.st_mtime])
+    key = json.dumps([files, seed, length, count])
+    return os.path.join(cache_dir, 'val-{}.npy'.format(hashlib.sha1(key.encode('utf8')).hexdigest()[:16]))
+
+
+def load_val_tokens(make_sampler, dataset, seed, length, count, cache_dir=None):
+    """Sample `count` validation sequences of `length` tokens into one [count, length] int32 array."""
+    path = val_cache_path(cache_dir, dataset, seed, length, count) if cache_dir else None
+    if path and os.path.exists(path):
+        print('Loading validation set from {}'.format(path))
+        return np.load(path)
+    sampler = make_sampler(dataset=dataset, seed=seed)
+    tokens = sampler.sample_batch(count, length, out=np.empty([count, length], dtype=np.int32))
+    if path:
+        maketree(cache_dir)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, tokens)
+        os.replace(path + '.tmp', path)
+    return tokens
+
+
 def randomize(context, hparams, p):
     if p > 0:
         mask = tf.random.uniform(shape=tf.shape(context)) < p
@@ -181,6 +247,8 @@ def main():
             "Can't get samples longer than window size: %s" % hparams.n_ctx)
     if args.sample_ctx < 0:
       args.sample_ctx = hparams.n_ctx
+    if args.val_eval_batch_size <= 0:
+        args.val_eval_batch_size = args.val_batch_size
 
     if args.model_name == '345M':
         args.memory_saving_gradients = True
@@ -192,21 +260,41 @@ def main():
         config.gpu_options.allow_growth = True
     if args.disable_layout_optimizer:
         config.graph_options.rewrite_options.layout_optimizer = rewriter_config_pb2.RewriterConfig.OFF
+    dist = args.dist_world_size > 1
+    is_chief = args.dist_rank == 0
+    ring = None
+    if dist:
+        print('Connecting to ranks as rank {} of {}...'.format(args.dist_rank, args.dist_world_size))
+        ring = tflex_dist.Ring(args.dist_rank, args.dist_world_size, host=args.dist_host, port=args.dist_port, timeout=args.dist_timeout)
+    # Other ranks log summaries and step timings next to rank 0's.
+    log_dir = os.path.join(CHECKPOINT_DIR, args.run_name) if is_chief else os.path.join(CHECKPOINT_DIR, args.run_name, 'rank-{}'.format(args.dist_rank))
+
     with tflex.Session(config=config, init_tpu=args.init_tpu) as sess:
         context = tf.placeholder(tf.int32, [args.batch_size, None])
         context_in = randomize(context, hparams, args.noise)
-        output = model.model(hparams=hparams, X=context_in)
-        loss = tf.reduce_mean(
-            tf.nn.sparse_softmax_cross_entropy_with_logits(
-                labels=context[:, 1:], logits=output['logits'][:, :-1]))
+        context_segments = tf.placeholder(tf.int32, [args.batch_size, None]) if args.pack else None
+        output = model.model(hparams=hparams, X=context_in, segments=context_segments)
+        losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=context[:, 1:], logits=output['logits'][:, :-1])
+        if args.pack:
+            # Only score predictions of a token from earlier tokens of its own document.
+            # Summed in float32, since batch * n_ctx losses can overflow float16.
+            weights = tf.cast(tf.equal(context_segments[:, 1:], context_segments[:, :-1]) &
+                              tf.not_equal(context_segments[:, 1:], 0), tf.float32)
+            loss = tf.reduce_sum(tf.cast(losses, tf.float32) * weights) / tf.maximum(tf.reduce_sum(weights), 1.0)
+        else:
+            loss = tf.reduce_mean(losses)
 
         if args.val_every > 0:
-            val_context = tf.placeholder(tf.int32, [args.val_batch_size, None])
-            val_output = model.model(hparams=hparams, X=val_context)
-            val_loss = tf.reduce_mean(
-                tf.nn.sparse_softmax_cross_entropy_with_logits(
-                    labels=val_context[:, 1:], logits=val_output['logits'][:, :-1]))
-            val_loss_summary = tf.summary.scalar('val_loss', val_loss)
+            # Shares the training weights; the batch size is left open so the
+            # whole validation set goes through in val_eval_batch_size chunks.
+            with tf.device(args.val_device):
+                val_context = tf.placeholder(tf.int32, [None, None])
+                val_output = model.model(hparams=hparams, X=val_context)
+                val_losses = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    labels=val_context[:, 1:], logits=val_output['logits'][:, :-1])
+                val_loss_sum = tf.reduce_sum(tf.cast(val_losses, tf.float32))
+                val_token_count = tf.size(val_losses)
 
 
         tf_sample = sample.sample_sequence(
@@ -234,33 +322,27 @@ def main():
                     warmup_steps=args.learning_rate_warmup, initial_period_steps=args.learning_rate_period, learning_rate_min=args.learning_rate_min)
             else:
                 lr = tflex.get_variable('learn_rate') or tf.get_variable('learn_rate', shape=(), dtype=tf.float32, trainable=False)
-                lr.load(args.learning_rate, session=sess)
-
-        def update_lr(rate=None, step=None):
-          if not args.learning_rate_cos:
-            if step is None:
-              step = global_step.eval(session=sess)
-            if rate is None:
-              rate = args.learning_rate
-            if callable(rate):
-              rate = rate(step)
-            lr.load(rate, session=sess)
-          return lr.eval(session=sess)
 
         @tflex.register_command
         def set_learning_rate():
-          print("Current learn rate: %0.8f" % update_lr())
+          print("Current learn rate: %0.8f" % sess.run(lr))
+          if args.learning_rate_cos:
+            print("The learn rate follows --learning_rate_cos; not changing anything.")
+            return
           print("New learn rate?")
           rate = input('')
           if not rate:
             print("Empty input; not changing anything.")
-          else:
-            try:
-              rate = float(rate)
-            except:
-              print("Invalid input; must be a float")
+            return
+          try:
+            rate = float(rate)
+          except:
+            print("Invalid input; must be a float")
+            return
           print("Setting learn rate to %0.8f" % rate)
           args.learning_rate = rate
+          # The schedule is computed in-graph, so the variable only changes here.
+          lr.load(rate, session=sess)
 
         if args.optimizer == 'adam':
             opt = tf.train.AdamOptimizer(learning_rate=lr)
@@ -292,31 +374,60 @@ def main():
                 var_list=train_vars)
             opt_reset = opt.reset()
             opt_compute = opt.compute_gradients(loss)
-            opt_apply = opt.apply_gradients()
-            summary_loss = tf.summary.scalar('loss', opt_apply)
+            if dist:
+                dist_grads = [(opt.accum_vars[v], v) for v in train_vars]
+                dist_opt = opt.opt
+                dist_loss = opt.total_loss / opt.count_loss
+            else:
+                opt_apply = opt.apply_gradients(global_step=global_step)
+            grad_norm = tf.global_norm(list(opt.accum_vars.values()))
         else:
             if args.memory_saving_gradients:
                 opt_grads = memory_saving_gradients.gradients(loss, train_vars)
             else:
                 opt_grads = tf.gradients(loss, train_vars)
             opt_grads = list(zip(opt_grads, train_vars))
-            opt_apply = opt.apply_gradients(opt_grads)
-            summary_loss = tf.summary.scalar('loss', loss)
-
-        summary_lr = tf.summary.scalar('learning_rate', lr)
-        summaries = tf.summary.merge([summary_lr, summary_loss])
-
+            if dist:
+                dist_grads = opt_grads
+                dist_opt = opt
+                dist_loss = loss
+            else:
+                opt_apply = opt.apply_gradients(opt_grads, global_step=global_step)
+            grad_norm = tf.global_norm([g for g, v in opt_grads if g is not None])
+
+        if dist:
+            # Each rank fetches its gradients as one vector, the ranks average
+            # them (plus the loss) on the host, and all apply the same update.
+            flat_grads = tflex_dist.flatten_gradients(dist_grads)
+            dist_grads_in, opt_apply = tflex_dist.apply_flat_gradients(dist_opt, train_vars, global_step=global_step)
+            dist_buf = np.zeros([sum([int(np.prod(v.shape.as_list())) for v in train_vars]) + 1], dtype=np.float32)
+
+        # Scalars are written with scalar_summary from values the training
+        # step already fetches; the writer flushes on its own thread.
         summary_log = tf.summary.FileWriter(
-            os.path.join(CHECKPOINT_DIR, args.run_name))
+            log_dir,
+            flush_secs=args.summary_flush_secs)
 
         if args.save_graph:
             summary_log.add_graph(tf.get_default_graph())
 
+        state_vars = []
+        if args.save_training_state:
+            state_vars = opt.variables() + [global_step]
+
         saver = tflex.Saver(
             var_list=all_vars,
+            state_var_list=state_vars,
+            state_dtype=args.training_state_dtype,
+            sharded=max(0, args.save_shards),
             max_to_keep=args.max_to_keep,
-            keep_checkpoint_every_n_hours=2,
-            reshape=args.truncate_weights)
+            keep_checkpoint_every_n_hours=args.keep_checkpoint_every_n_hours,
+            archive_dir=args.archive_dir,
+            reshape=args.truncate_weights,
+            async_save=args.save_async,
+            restore_threads=args.restore_threads,
+            save_dtype=args.save_dtype,
+            compression=args.save_compression)
         sess.run(tf.global_variables_initializer())
 
         if args.restore_from == 'latest':
@@ -337,26 +448,57 @@ def main():
             saver.restore(sess, ckpt)
         t1 = time.time()
         print('Loaded in %f seconds' % (t1 - t0))
-
-        def make_sampler(dataset, enc, seed, combine):
-          if os.path.isdir(dataset) or dataset.endswith('.npz'):
-            chunks = load_dataset(enc, dataset, combine)
+        if global_step.name in [v.name for v in saver.restored_var_list]:
+            current_step = int(global_step.eval(session=sess))
+            print('Resuming from step', current_step)
+        else:
+            global_step.load(current_step, session=sess)
+        if not args.learning_rate_cos:
+            lr.load(args.learning_rate, session=sess)
+        if dist:
+            # Start every rank from rank 0's weights (they differ for --fresh_model).
+            print('Broadcasting variables from rank 0...')
+            names = set([v.name for v in all_vars])
+            dist_vars = all_vars + [v for v in [global_step] + state_vars if v.name not in names]
+            tflex_dist.broadcast_variables(ring, sess, dist_vars)
+
+        def make_sampler(dataset, enc, seed, combine, pack=False, shard_index=0, shard_count=1):
+          # Each rank only reads its own shard of the dataset.
+          if pack:
+            if dataset.endswith('.tok'):
+              tokens, boundaries = load_tokens(dataset)
+              chunks = [tokens[start:end] for start, end in zip(boundaries[:-1], boundaries[1:])]
+              chunks = shard_chunks(chunks, shard_index, shard_count)
+            else:
+              chunks = load_dataset(enc, dataset, combine, shard_index=shard_index, shard_count=shard_count)
+            data_sampler = PackedSampler(chunks, eot=enc.encoder['<|endoftext|>'], max_length=args.sample_ctx, seed=seed)
+            print('dataset has', data_sampler.total_size, 'tokens', data_sampler.chunk_count, 'documents')
+          elif dataset.endswith('.tok'):
+            data_sampler = MemmapSampler(dataset, seed=seed).shard(shard_index, shard_count)
+            print('dataset has', data_sampler.total_size, 'tokens', data_sampler.chunk_count, 'chunks')
+          elif os.path.isdir(dataset) or dataset.endswith('.npz'):
+            chunks = load_dataset(enc, dataset, combine, shard_index=shard_index, shard_count=shard_count)
             data_sampler = Sampler(chunks, seed=seed)
             print('dataset has', data_sampler.total_size, 'tokens', len(chunks), 'chunks')
           else:
-            data_sampler = TextSampler(dataset, enc, seed=seed)
+            data_sampler = TextSampler(dataset, enc, seed=seed, use_locking=args.prefetch > 0).shard(shard_index, shard_count)
           return data_sampler
 
         print('Loading dataset...')
-        seed = None if args.seed < 0 else args.seed
-        data_sampler = make_sampler(dataset=args.dataset, enc=enc, seed=seed, combine=args.combine)
-        if args.val_every > 0:
+        seed = None if args.seed < 0 else args.seed + args.dist_rank
+        data_sampler = make_sampler(dataset=args.dataset, enc=enc, seed=seed, combine=args.combine, pack=args.pack,
+                                    shard_index=args.dist_rank, shard_count=args.dist_world_size)
+        if 'sampler_rng_keys' in saver.state and is_chief:
+            print('Restoring dataset sampler state')
+            data_sampler.set_state(dict([(k[len('sampler_'):], v) for k, v in saver.state.items() if k.startswith('sampler_')]))
+        if args.val_every > 0 and is_chief:
             # Sample from validation set once with fixed seed to make
             # it deterministic during training as well as across runs.
             val_dataset = args.val_dataset if args.val_dataset else args.dataset
-            val_data_sampler = make_sampler(dataset=val_dataset, enc=enc, seed=1, combine=args.combine)
-            val_batches = [[val_data_sampler.sample(hparams.n_ctx) for _ in range(args.val_batch_size)]
-                           for _ in range(args.val_batch_count)]
+            val_tokens = load_val_tokens(
+                lambda dataset, seed: make_sampler(dataset=dataset, enc=enc, seed=seed, combine=args.combine),
+                val_dataset, seed=1, length=hparams.n_ctx, count=args.val_batch_size * args.val_batch_count,
+                cache_dir=args.val_cache_dir)
 
         print('Training...')
         counter = 1
@@ -366,6 +508,8 @@ def main():
             # Add 1 so we don't immediately try to save again
             with open(counter_path, 'r') as fp:
                 counter = int(fp.read()) + 1
+        if 'counter' in saver.state:
+            counter = int(saver.state['counter']) + 1
 
         @tflex.register_command
         def save():
@@ -375,19 +519,40 @@ def main():
                 os.path.join(CHECKPOINT_DIR, args.run_name,
                              'model-{}').format(counter))
             t0 = time.time()
+            state = None
+            if args.save_training_state:
+                sampler_state = prefetcher.get_state() if prefetcher is not None else data_sampler.get_state()
+                state = dict([('sampler_' + k, v) for k, v in sampler_state.items()])
+                state['counter'] = counter
+            saved_counter = counter
+
+            def on_saved(prefix):
+                # Only advance the counter file once the checkpoint is on
+                # disk, so a resume never pairs it with older weights.
+                print('Saved %s in %f seconds' % (prefix, time.time() - t0))
+                with open(counter_path, 'w') as fp:
+                    fp.write(str(saved_counter) + '\n')
+
             saver.save(
                 sess,
                 os.path.join(CHECKPOINT_DIR, args.run_name, 'model'),
-                global_step=counter)
-            t1 = time.time()
-            print('Saved in %f seconds' % (t1 - t0))
-            with open(counter_path, 'w') as fp:
-                fp.write(str(counter) + '\n')
+                global_step=counter,
+                state=state,
+                on_saved=on_saved)
 
         @tflex.register_command
         def generate_samples():
             print('Generating samples...')
-            context_tokens = data_sampler.sample(1)
+            # Don't draw from the sampler while the prefetcher is using it,
+            # so the training batches stay deterministic.
+            batch = last_batch
+            if batch is None and prefetcher is not None:
+                batch = prefetcher.peek()
+            if batch is not None:
+                rows = batch[0] if args.pack else batch
+                context_tokens = rows[0][0:1]
+            else:
+                context_tokens = data_sampler.sample(1)
             all_text = []
             index = 0
             while index < args.sample_num:
@@ -407,28 +572,44 @@ def main():
                                  'samples-{}').format(counter), 'w') as fp:
                 fp.write('\n'.join(all_text))
 
-        @tflex.register_command
-        def validation():
-            if args.val_every <= 0:
-              return
-            print('Calculating validation loss...')
-            losses = []
-            for batch in tqdm.tqdm(val_batches):
-                loss = sess.run(val_loss, feed_dict={val_context: batch})
-                losses.append(loss)
-                v_val_loss = np.mean(losses)
-                print('{n} loss={loss:2.4f} avg={avg:2.4f}'.format(n=len(losses), loss=loss, avg=v_val_loss))
-            print('losses', losses)
-            v_summary = sess.run(val_loss_summary, feed_dict={val_loss: v_val_loss})
-            summary_log.add_summary(v_summary, counter)
-            summary_log.flush()
+        def run_validation(step):
+            t0 = time.time()
+            total_loss = 0.0
+            total_tokens = 0
+            for i in range(0, len(val_tokens), args.val_eval_batch_size):
+                v_loss_sum, v_tokens = sess.run(
+                    (val_loss_sum, val_token_count),
+                    feed_dict={val_context: val_tokens[i:i + args.val_eval_batch_size]})
+                total_loss += v_loss_sum
+                total_tokens += v_tokens
+            v_val_loss = total_loss / max(1, total_tokens)
+            summary_log.add_summary(scalar_summary(val_loss=v_val_loss), step)
             print(
-                '{stamp} [{counter} | {time:2.4f}] validation loss = {loss:2.4f}'
+                '{stamp} [{counter} | {time:2.4f}] validation loss = {loss:2.4f} ({n} sequences in {secs:2.2f}s, {ops:2.2f}tokens/s)'
                 .format(
                     stamp=timestamp(),
-                    counter=counter,
+                    counter=step,
                     time=time.time() - start_time,
-                    loss=v_val_loss))
+                    loss=v_val_loss,
+                    n=len(val_tokens),
+                    secs=time.time() - t0,
+                    ops=val_tokens.size / (time.time() - t0)))
+
+        val_thread = None
+
+        @tflex.register_command
+        def validation():
+            nonlocal val_thread
+            if args.val_every <= 0:
+              return
+            if not args.val_async:
+                print('Calculating validation loss...')
+                run_validation(counter)
+            elif val_thread is not None and val_thread.is_alive():
+                print('Previous validation pass still running; skipping')
+            else:
+                val_thread = threading.Thread(target=run_validation, args=(counter,), daemon=True)
+                val_thread.start()
 
         start_time = time.time()
         
@@ -438,109 +619,173 @@ def main():
         def say(msg):
             print('{stamp} [{counter} | {time:2.4f}] {msg}'.format(counter=counter, time=elapsed(), msg=msg, stamp=timestamp()))
 
+        prefetcher = None
+        if args.prefetch > 0:
+            prefetcher = Prefetcher(data_sampler, args.batch_size, args.sample_ctx, depth=args.prefetch)
+        last_batch = None
+
         def sample_batch():
-            #return [data_sampler.sample(args.sample_ctx) for _ in range(args.batch_size)]
-            #say('Sampling batch...')
-            r = []
-            times = []
-            for _ in range(args.batch_size):
-                start = time.time()
-                sample = data_sampler.sample(args.sample_ctx)
-                end = time.time()
-                elapsed = (end - start)
-                r += [sample]
-                times += [elapsed]
-            total = sum(times)
-            avg = total / len(times)
-            #say('Sampled %d batches in %.4f seconds (avg per batch: %.4f)' % (args.batch_size, total, avg))
-            return r
+            nonlocal last_batch
+            if prefetcher is not None:
+                last_batch = prefetcher.get()
+            else:
+                last_batch = data_sampler.sample_batch(args.batch_size, args.sample_ctx)
+            return last_batch
+
+        def batch_feed(batch):
+            if args.pack:
+                tokens, segments = batch
+                return {context: tokens, context_segments: segments}
+            return {context: np.asarray(batch, dtype=np.int32)}
 
         prev_time = time.time()
         avg_loss = (0.0, 0.0)
+        tokens_per_step = args.sample_ctx * args.batch_size * max(1, args.accumulate_gradients)
 
         if args.debug_before_training:
             import pdb
             pdb.set_trace()
 
         last_saved_time = elapsed()
+        timer = tflex_profile.StepTimer(
+            os.path.join(log_dir, 'timing.jsonl') if args.timing_every > 0 else None,
+            window=args.timing_window,
+            every=args.timing_every)
         while True:
             try:
+                timer.start(counter)
                 now = elapsed()
-                if args.save_time > 0 and (((now - last_saved_time) / 60.0) >= args.save_time):
-                    save()
-                    last_saved_time = now
-                elif args.save_every > 0 and (counter % args.save_every == 0):
-                    save()
-                if args.sample_every > 0 and counter % args.sample_every == 0:
-                    generate_samples()
-                if args.val_every > 0 and (counter % args.val_every == 0 or counter == 1):
-                    validation()
-
-                v_rate = update_lr()
-
+                with timer.phase('checkpoint'):
+                    if not is_chief:
+                        pass
+                    elif args.save_time > 0 and (((now - last_saved_time) / 60.0) >= args.save_time):
+                        save()
+                        last_saved_time = now
+                    elif args.save_every > 0 and (counter % args.save_every == 0):
+                        save()
+                with timer.phase('eval'):
+                    if is_chief and args.sample_every > 0 and counter % args.sample_every == 0:
+                        generate_samples()
+                    if is_chief and args.val_every > 0 and (counter % args.val_every == 0 or counter == 1):
+                        validation()
+
+                write_summary = args.summary_every > 0 and counter % args.summary_every == 0
+                fetches = {'rate': lr}
+                if dist:
+                    fetches['grads'] = flat_grads
+                elif write_summary:
+                    fetches['grad_norm'] = grad_norm
+                run_options, run_metadata = tflex_profile.trace_options() if counter == args.profile_step else (None, None)
                 if args.accumulate_gradients > 1:
-                    #say('Running opt_reset...')
-                    sess.run(opt_reset)
+                    with timer.phase('run'):
+                        #say('Running opt_reset...')
+                        sess.run(opt_reset)
                     for _ in range(args.accumulate_gradients):
-                        batch = sample_batch()
-                        say('Running opt_compute...')
-                        sess.run(opt_compute, feed_dict={context: batch})
-                    say('Running opt_apply...')
-                    (v_loss, v_summary) = sess.run((opt_apply, summaries))
+                        with timer.phase('sample'):
+                            batch = sample_batch()
+                        with timer.phase('feed'):
+                            feed_dict = batch_feed(batch)
+                        with timer.phase('run'):
+                            say('Running opt_compute...')
+                            sess.run(opt_compute, feed_dict=feed_dict)
+                    with timer.phase('run'):
+                        say('Running opt_apply...')
+                        fetches['loss'] = dist_loss if dist else opt_apply
+                        v = sess.run(fetches, options=run_options, run_metadata=run_metadata)
                 else:
-                    batch = sample_batch()
-                    say('Running opt_apply...')
-                    (_, v_loss, v_summary) = sess.run(
-                        (opt_apply, loss, summaries),
-                        feed_dict={context: batch})
-
-                if args.float16:
-                    v_loss = tf.to_float(v_loss).eval()
-
-                summary_log.add_summary(v_summary, counter)
-                summary_log.flush()
+                    with timer.phase('sample'):
+                        batch = sample_batch()
+                    with timer.phase('feed'):
+                        feed_dict = batch_feed(batch)
+                    with timer.phase('run'):
+                        say('Running opt_apply...')
+                        fetches['loss'] = loss
+                        if dist:
+                            v = sess.run(fetches, feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)
+                        else:
+                            v = sess.run((opt_apply, fetches), feed_dict=feed_dict, options=run_options, run_metadata=run_metadata)[1]
+                if dist:
+                    with timer.phase('allreduce'):
+                        dist_buf[:-1] = v.pop('grads')
+                        dist_buf[-1] = v['loss']
+                        ring.allreduce(dist_buf)
+                        dist_buf /= args.dist_world_size
+                    with timer.phase('run'):
+                        sess.run(opt_apply, feed_dict={dist_grads_in: dist_buf[:-1]})
+                    v['loss'] = dist_buf[-1]
+                    if write_summary:
+                        v['grad_norm'] = np.linalg.norm(dist_buf[:-1])
+                if run_metadata is not None:
+                    timeline_path = os.path.join(log_dir, 'timeline-{}.json'.format(counter))
+                    tflex_profile.write_timeline(run_metadata, timeline_path)
+                    summary_log.add_run_metadata(run_metadata, 'step{}'.format(counter), counter)
+                    say('Wrote timeline to {}'.format(timeline_path))
+
+                v_loss = float(v['loss'])
+                v_rate = v['rate']
 
                 avg_loss = (avg_loss[0] * 0.99 + v_loss,
                             avg_loss[1] * 0.99 + 1.0)
 
                 now = time.time()
-                print('{stamp} [{counter} | {time:2.4f} | {delta:2.2f}s | {ops:2.6f}tokens/s] loss={loss:2.4f} avg={avg:2.4f} rate={rate:0.7f} step={step}'
-                    .format(
-                        stamp=timestamp(),
-                        counter=counter,
-                        time=now - start_time,
-                        delta=now - prev_time,
-                        ops=args.sample_ctx * args.batch_size / (now - prev_time),
-                        rate=v_rate,
-                        loss=v_loss,
-                        avg=avg_loss[0] / avg_loss[1],
-                        step=current_step,
-                        ))
+                with timer.phase('summaries'):
+                    if write_summary:
+                        summary_log.add_summary(scalar_summary(
+                            loss=v_loss,
+                            learning_rate=v_rate,
+                            grad_norm=v['grad_norm'],
+                            tokens_per_sec=tokens_per_step / (now - prev_time),
+                            step_time=now - prev_time,
+                            sample_time=timer.phases.get('sample', 0.0),
+                            run_time=timer.phases.get('run', 0.0)), counter)
+                    print('{stamp} [{counter} | {time:2.4f} | {delta:2.2f}s | {ops:2.6f}tokens/s] loss={loss:2.4f} avg={avg:2.4f} rate={rate:0.7f} step={step}{prefetch}'
+                        .format(
+                            stamp=timestamp(),
+                            counter=counter,
+                            time=now - start_time,
+                            delta=now - prev_time,
+                            ops=tokens_per_step / (now - prev_time),
+                            rate=v_rate,
+                            loss=v_loss,
+                            avg=avg_loss[0] / avg_loss[1],
+                            step=current_step,
+                            prefetch='' if prefetcher is None else ' queue={} stall={:2.4f}s'.format(prefetcher.depth(), prefetcher.stall_time),
+                            ))
+                    if args.timing_report > 0 and counter % args.timing_report == 0:
+                        say('step time p50/p90/p99: ' + timer.report())
 
                 counter += 1
+                # opt_apply increments global_step in-graph; mirror it here.
                 current_step += 1
-                global_step.load(current_step, session=sess)
 
-                tflex.check_commands_with_args(
-                    session=sess,
-                    stamp=timestamp(),
-                    counter=counter,
-                    time=now - start_time,
-                    delta=now - prev_time,
-                    ops=args.batch_size / (now - prev_time),
-                    rate=v_rate,
-                    loss=v_loss,
-                    avg=avg_loss[0] / avg_loss[1],
-                    avg_loss=avg_loss,
-                    step=current_step,
-                    train_vars=train_vars,
-                    all_vars=all_vars,
-                    args=args,
-                    data_sampler=data_sampler,
-                    ckpt=ckpt,
-                    saver=saver,
-                    )
-                if tflex.should_quit():
+                with timer.phase('commands'):
+                    if is_chief:
+                        tflex.check_commands_with_args(
+                            session=sess,
+                            stamp=timestamp(),
+                            counter=counter,
+                            time=now - start_time,
+                            delta=now - prev_time,
+                            ops=tokens_per_step / (now - prev_time),
+                            rate=v_rate,
+                            loss=v_loss,
+                            avg=avg_loss[0] / avg_loss[1],
+                            avg_loss=avg_loss,
+                            step=current_step,
+                            train_vars=train_vars,
+                            all_vars=all_vars,
+                            args=args,
+                            data_sampler=data_sampler,
+                            prefetcher=prefetcher,
+                            ckpt=ckpt,
+                            saver=saver,
+                            timer=timer,
+                            )
+                    if dist:
+                        # Rank 0's commands decide when every rank stops.
+                        quit_flag = ring.broadcast(np.array([tflex.should_quit() if is_chief else False], dtype=np.uint8))
+                timer.end(loss=v_loss, tokens=tokens_per_step)
+                if (quit_flag[0] if dist else tflex.should_quit()):
                   break
 
                 prev_time = now
@@ -567,15 +812,26 @@ def main():
                         param_count += count
                     print('Total parameters:', param_count)
                     args.debug_print_trainable_vars = False
+            except ConnectionError as e:
+                # Another rank stopped or hung; there is no one to train with.
+                print('{}; stopping'.format(e))
+                break
             except KeyboardInterrupt:
                 print('interrupted')
-                if args.save_on_ctrlc:
+                if args.save_on_ctrlc and is_chief:
                     save()
                 if args.debug_on_ctrlc:
                     import pdb
                     pdb.set_trace()
                 else:
                     break
+        if val_thread is not None:
+            val_thread.join()
+        saver.wait()
+        summary_log.close()
+        timer.close()
+        if ring is not None:
+            ring.close()
 
 if __name__ == '__main__':
     main()